@@ -13,6 +13,8 @@ def get_args_parser():
     parser.add_argument('--lr_drop', default=120, type=int)
     parser.add_argument('--clip_max_norm', default=0.1, type=float,
                         help='gradient clipping max norm')
+    parser.add_argument('--gradient_checkpointing', default=False, type=lambda x: (str(x).lower() == 'true'),
+                        help='recompute text transformer and visual decoder activations in backward to save memory')
 
     # Model Setting
     parser.add_argument('--clip_model', default="ViT-B/16", type=str,
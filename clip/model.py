@@ -1,3 +1,4 @@
+import os
 from collections import OrderedDict
 from typing import Tuple, Union
 
@@ -179,9 +180,20 @@ class LayerNorm(nn.LayerNorm):
         return ret.type(orig_type)
 
 
+def _quick_gelu(x: torch.Tensor):
+    return x * torch.sigmoid(1.702 * x)
+
+
+# compiled so the sigmoid and multiply run as one kernel, but only when
+# INPCC_COMPILE is set: the default stays eager so environments without a
+# working inductor/triton toolchain keep working
+if os.environ.get("INPCC_COMPILE", "0") != "0":
+    _quick_gelu = torch.compile(_quick_gelu, fullgraph=True)
+
+
 class QuickGELU(nn.Module):
     def forward(self, x: torch.Tensor):
-        return x * torch.sigmoid(1.702 * x)
+        return _quick_gelu(x)
 
 
 class ResidualAttentionBlock(nn.Module):
@@ -200,7 +212,12 @@ class ResidualAttentionBlock(nn.Module):
 
     def attention(self, x: torch.Tensor):
         self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        attn_mask = self.attn_mask
+        if attn_mask is not None and attn_mask.shape[0] != x.shape[0]:
+            # sequences shorter than the cached causal mask (batches padded to
+            # their own max length) use its top-left corner
+            attn_mask = attn_mask[:x.shape[0], :x.shape[0]]
+        return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
 
     def forward(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
@@ -390,26 +407,12 @@ class CLIP(nn.Module):
 
 def convert_weights(model: nn.Module):
     """Convert applicable model parameters to fp16"""
-
-    def _convert_weights_to_fp16(l):
-        if isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Linear)):
-            l.weight.data = l.weight.data.half()
-            if l.bias is not None:
-                l.bias.data = l.bias.data.half()
-
-        if isinstance(l, nn.MultiheadAttention):
-            for attr in [*[f"{s}_proj_weight" for s in ["in", "q", "k", "v"]], "in_proj_bias", "bias_k", "bias_v"]:
-                tensor = getattr(l, attr)
-                if tensor is not None:
-                    tensor.data = tensor.data.half()
-
-        for name in ["text_projection", "proj"]:
-            if hasattr(l, name):
-                attr = getattr(l, name)
-                if attr is not None:
-                    attr.data = attr.data.half()
-
-    model.apply(_convert_weights_to_fp16)
+    model.half()
+    # LayerNorm stays in fp32 (CLIP convention): its reductions are
+    # accuracy-sensitive in half precision
+    for m in model.modules():
+        if isinstance(m, nn.LayerNorm):
+            m.float()
 
 
 def build_model(state_dict: dict):
@@ -171,7 +171,13 @@ def evaluate(model, postprocessors, criterion, data_loader, device, args):
             vision_outputs = {}
             key_lst = list(vision_output_lst[0].keys())
             for k in key_lst:
-                vision_outputs[k] = torch.cat([vision_output_lst[scale_i][k] for scale_i in range(len(vision_output_lst))], dim=1)
+                values = [vision_output_lst[scale_i][k] for scale_i in range(len(vision_output_lst))]
+                if not torch.is_tensor(values[0]):
+                    # attn_maps is None unless the visualizer requested weights;
+                    # region-prompt lists keep level 0's
+                    vision_outputs[k] = values[0]
+                    continue
+                vision_outputs[k] = torch.cat(values, dim=1)
         else:
             feature_maps = model.vision_proj(feature_maps) # torch.Size([8, 196, 768])
             vision_outputs = model.hoi_visual_decoder(image=feature_maps, mask=decoder_mask, prompt_hint=prompt_hint)
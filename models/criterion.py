@@ -1,5 +1,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 # Modified by Suchen for HOI detection
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn.functional as F
 from torch import nn
@@ -7,6 +10,55 @@ from utils import box_ops
 from utils.misc import accuracy, get_world_size, is_dist_avail_and_initialized
 
 
+def _maybe_compile(**compile_kwargs):
+    """ torch.compile when INPCC_COMPILE is set, identity otherwise: the default
+    eager configuration must not require an inductor/triton toolchain.
+    """
+    if os.environ.get("INPCC_COMPILE", "0") != "0":
+        return lambda fn: torch.compile(fn, **compile_kwargs)
+    return lambda fn: fn
+
+
+@_maybe_compile(mode="reduce-overhead", fullgraph=True)
+def _focal_core(x, y, alpha, gamma, eps):
+    # Elementwise body of the focal loss, compiled so inductor fuses it into a
+    # single kernel. BCE-with-logits is written out explicitly (its stable form
+    # softplus(-x) + (1-y)*x) so the whole chain stays in one graph and sigma(x)
+    # is reused instead of being recomputed inside F.binary_cross_entropy_with_logits.
+    bce = F.softplus(-x) + (1 - y) * x
+    return (1 - y - alpha).abs() * ((y - torch.sigmoid(x)).abs() + eps) ** gamma * bce
+
+
+@_maybe_compile(fullgraph=True, dynamic=True)
+def _compute_bbox_loss(src_boxes, target_boxes, num_boxes):
+    # L1 + matched-pair GIoU on the [N, 8] paired boxes, compiled so the long
+    # conversion/min/max/clamp/divide chain fuses into a few kernels. The pairwise
+    # GIoU is inlined without the degenerate-box asserts of the box_ops version,
+    # which would break the graph on data-dependent control flow.
+    loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none').sum() / num_boxes
+
+    src_all = box_ops.box_cxcywh_to_xyxy(src_boxes.reshape(-1, 4))
+    tgt_all = box_ops.box_cxcywh_to_xyxy(target_boxes.reshape(-1, 4))
+
+    area1 = (src_all[:, 2] - src_all[:, 0]) * (src_all[:, 3] - src_all[:, 1])
+    area2 = (tgt_all[:, 2] - tgt_all[:, 0]) * (tgt_all[:, 3] - tgt_all[:, 1])
+    lt = torch.max(src_all[:, :2], tgt_all[:, :2])
+    rb = torch.min(src_all[:, 2:], tgt_all[:, 2:])
+    wh = (rb - lt).clamp(min=0)
+    inter = wh[:, 0] * wh[:, 1]
+    union = area1 + area2 - inter
+    iou = inter / union
+
+    lt = torch.min(src_all[:, :2], tgt_all[:, :2])
+    rb = torch.max(src_all[:, 2:], tgt_all[:, 2:])
+    wh = (rb - lt).clamp(min=0)
+    area = wh[:, 0] * wh[:, 1]
+    giou = iou - (area - union) / area
+
+    loss_giou = (1 - giou).sum() / num_boxes
+    return loss_bbox, loss_giou
+
+
 class SetCriterion(nn.Module):
     """ This class computes the loss for DETR.
     The process happens in two steps:
@@ -30,7 +82,11 @@ class SetCriterion(nn.Module):
         self.focal_alpha = focal_alpha
         self.focal_gamma = focal_gamma
         self.consider_all = consider_all
-    
+        # Worker used to run the CPU-bound Hungarian assignments (scipy) concurrently
+        # with the GPU loss kernels of the final layer.
+        self._matcher_executor = ThreadPoolExecutor(max_workers=1)
+        self._cached_src_idx = None
+
     def binary_focal_loss_with_logits(
         self,
         x: torch.Tensor, y: torch.Tensor,
@@ -65,10 +121,14 @@ class SetCriterion(nn.Module):
         loss: Tensor
             Computed loss tensor
         """
-        loss = (1 - y - alpha).abs() * ((y-torch.sigmoid(x)).abs() + eps) ** gamma * \
-            torch.nn.functional.binary_cross_entropy_with_logits(
-                x, y, reduction='none'
-            )
+        # Reductions stay outside the compiled region so shape changes do not recompile.
+        # The elementwise chain is bandwidth-bound and safe in bfloat16 (|y - sigmoid(x)|
+        # is bounded by 1, so the pow stays in range); the reduction below accumulates
+        # in fp32 after the .float() upcast.
+        if x.is_cuda:
+            loss = _focal_core(x.to(torch.bfloat16), y.to(torch.bfloat16), alpha, gamma, eps).float()
+        else:
+            loss = _focal_core(x, y, alpha, gamma, eps)
         if reduction == 'mean':
             return loss.mean()
         elif reduction == 'sum':
@@ -88,14 +148,26 @@ class SetCriterion(nn.Module):
         idx = self._get_src_permutation_idx(indices)
         # focal loss
         if self.enable_focal_loss:
-            labels = torch.zeros_like(src_logits[idx], device=src_logits.device)
-            labels[torch.arange(src_logits[idx].shape[0]).to(src_logits.device), target_classes_i] = 1
-            focal_loss = self.binary_focal_loss_with_logits(src_logits[idx], labels, reduction='sum', alpha=self.focal_alpha, gamma=self.focal_gamma)
-            focal_loss = focal_loss / len(labels)
+            # Focal loss without materializing the one-hot label matrix: every position
+            # is evaluated with the negative-label form, then the positive columns are
+            # gathered and corrected in O(N) instead of zero-filling and scattering a
+            # full [N, C] target just to mark N ones. Both forms run through the
+            # compiled _focal_core kernel (scalar labels broadcast inside the graph),
+            # in bfloat16 on CUDA with the reductions accumulating in fp32.
+            x = src_logits[idx]
+            x_pos = x.gather(1, target_classes_i[:, None])
+            eps = 1e-6
+            if x.is_cuda:
+                x, x_pos = x.to(torch.bfloat16), x_pos.to(torch.bfloat16)
+            neg_loss = _focal_core(x, x.new_zeros(()), self.focal_alpha, self.focal_gamma, eps).float()
+            pos_loss = _focal_core(x_pos, x_pos.new_ones(()), self.focal_alpha, self.focal_gamma, eps).float()
+            neg_at_pos = neg_loss.gather(1, target_classes_i[:, None])
+            focal_loss = (neg_loss.sum() - neg_at_pos.sum() + pos_loss.sum()) / len(x)
             losses = {'loss_ce': focal_loss}
         else:
-            # image-to-text alignment loss
-            loss_i = F.cross_entropy(src_logits[idx], target_classes_i)
+            # image-to-text alignment loss, as a gather on an explicit log-softmax
+            # instead of F.cross_entropy recomputing it internally
+            loss_i = -F.log_softmax(src_logits[idx], dim=-1).gather(1, target_classes_i[:, None]).mean()
             # text-to-image alignment loss
             if self.training:
                 num_tgts = target_classes_t.shape[1]
@@ -112,41 +184,46 @@ class SetCriterion(nn.Module):
     def masked_out_cross_entropy(self, src_logits, target_classes):
         loss = 0
         num_pos = target_classes.sum(dim=-1)
+        # One log-softmax over the full matrix serves every row with a single positive
+        # label; only the multi-positive rows below need their own masked normalizers.
+        log_probs = F.log_softmax(src_logits, dim=-1)
         # If there is only one active positive label, then this will be ordinary cross entropy
         indices = torch.nonzero(num_pos < 2, as_tuple=True)[0]
         targets_one_pos = torch.argmax(target_classes[indices], dim=-1)
-        loss += F.cross_entropy(src_logits[indices], targets_one_pos, reduction="sum")
-
-        # If there are multiple positive labels, then we compute them one by one. Each time,
-        # the other positive labels are masked out.
-        indices = torch.nonzero(num_pos > 1, as_tuple=True)[0]
-        for i in indices:
-            t = target_classes[i]
-            cnt = sum(t)
-            loss_t = 0
-            for j in torch.nonzero(t):
-                mask = (t == 0)
-                mask[j] = True
-                tgt = t[mask].argmax(dim=-1, keepdim=True)
-                loss_t += F.cross_entropy(src_logits[i:i+1, mask], tgt, reduction="sum")
-            loss += (loss_t / cnt)
+        loss += -log_probs[indices].gather(1, targets_one_pos[:, None]).sum()
+
+        # If there are multiple positive labels, all (row, positive) pairs are computed in one
+        # batched cross entropy. For each pair, the other positive labels are masked out.
+        multi_pos = num_pos > 1
+        indices = torch.nonzero(multi_pos, as_tuple=True)[0]
+        if len(indices) > 0:
+            pairs = torch.nonzero(target_classes.bool() & multi_pos[:, None])
+            pair_rows, pair_js = pairs[:, 0], pairs[:, 1]
+            # Mask out the other positives of each row, keeping only position j
+            other_pos = target_classes[pair_rows].bool()
+            other_pos.scatter_(1, pair_js[:, None], False)
+            masked_logits = src_logits[pair_rows].masked_fill(other_pos, float("-inf"))
+            pair_loss = F.cross_entropy(masked_logits, pair_js, reduction="none")
+            # Accumulate per-row and normalize by the number of positives in each row
+            loss_per_row = torch.zeros_like(num_pos, dtype=pair_loss.dtype)
+            loss_per_row.index_add_(0, pair_rows, pair_loss)
+            loss += (loss_per_row[indices] / num_pos[indices]).sum()
         loss = loss / len(src_logits)
         return loss
 
     def loss_confidences(self, outputs, targets, indices, num_boxes, log=True):
         """ Bounding box confidence score for the interaction prediction. """
         assert 'box_scores' in outputs
-        box_scores = outputs['box_scores'].sigmoid()
+        box_scores = outputs['box_scores'].squeeze(-1)
 
         idx = self._get_src_permutation_idx(indices)
-        target_classes_o = torch.cat([torch.ones(len(J), dtype=torch.int64, device=box_scores.device) for t, (_, J) in zip(targets, indices)])
-        target_classes = torch.full(box_scores.shape[:2], 0, dtype=torch.int64, device=box_scores.device)
-        target_classes[idx] = target_classes_o
-        target_classes = target_classes.to(box_scores.dtype)
+        target_classes = torch.zeros_like(box_scores)
+        target_classes[idx] = 1.
 
         weight = torch.ones_like(target_classes) * self.eos_coef
         weight[idx] = 1.
-        loss_conf = F.binary_cross_entropy(box_scores.flatten(), target_classes.flatten(), weight=weight.flatten())
+        # the fused logit form skips the separate sigmoid pass and is numerically stabler
+        loss_conf = F.binary_cross_entropy_with_logits(box_scores, target_classes, weight=weight)
         losses = {'loss_conf': loss_conf}
         return losses
 
@@ -160,26 +237,17 @@ class SetCriterion(nn.Module):
         src_boxes = outputs['pred_boxes'][idx]
         target_boxes = []
         for t, (_, indices_per_t) in zip(targets, indices):
-            for i in indices_per_t:
-                person_id = t["hois"][i]["subject_id"]
-                object_id = t["hois"][i]["object_id"]
-                target_boxes.append(torch.cat([t["boxes"][person_id], t["boxes"][object_id]]))
-        target_boxes = torch.stack(target_boxes, dim=0)
+            subject_ids, object_ids = self._get_pair_ids(t)
+            target_boxes.append(torch.cat([
+                t["boxes"][subject_ids[indices_per_t]],
+                t["boxes"][object_ids[indices_per_t]]], dim=1))
+        target_boxes = torch.cat(target_boxes, dim=0)
 
-        loss_pbbox = F.l1_loss(src_boxes[:, :4], target_boxes[:, :4], reduction='none')
-        loss_obbox = F.l1_loss(src_boxes[:, 4:], target_boxes[:, 4:], reduction='none')
+        loss_bbox, loss_giou = _compute_bbox_loss(src_boxes, target_boxes, num_boxes)
 
         losses = {}
-        losses['loss_bbox'] = loss_pbbox.sum() / num_boxes + loss_obbox.sum() / num_boxes
-
-        loss_pgiou = 1 - torch.diag(box_ops.generalized_box_iou(
-            box_ops.box_cxcywh_to_xyxy(src_boxes[:, :4]),
-            box_ops.box_cxcywh_to_xyxy(target_boxes[:, :4])))
-        loss_ogiou = 1 - torch.diag(box_ops.generalized_box_iou(
-            box_ops.box_cxcywh_to_xyxy(src_boxes[:, 4:]),
-            box_ops.box_cxcywh_to_xyxy(target_boxes[:, 4:])))
-
-        losses['loss_giou'] = loss_pgiou.sum() / num_boxes + loss_ogiou.sum() / num_boxes
+        losses['loss_bbox'] = loss_bbox
+        losses['loss_giou'] = loss_giou
         return losses
 
     def loss_masks(self, outputs, targets, indices, num_boxes, log=False):
@@ -194,30 +262,26 @@ class SetCriterion(nn.Module):
         pred_obj_region = outputs['obj_region'][idx[0]]
         pred_uni_region = outputs['uni_region'][idx[0]]
 
-        # 收集目标的mask
+        # 收集目标的mask: 每张图一次index_select, 不再逐hoi地append+stack
         target_hum_masks = []
         target_obj_masks = []
-        
+
         for t, (_, indices_per_t) in zip(targets, indices):
-            for i in indices_per_t:
-                person_id = t["hois"][i]["subject_id"]
-                object_id = t["hois"][i]["object_id"]
-                target_hum_masks.append(t["mask_region_hw"][person_id])  # 取人mask
-                target_obj_masks.append(t["mask_region_hw"][object_id])  # 取物体mask
+            subject_ids, object_ids = self._get_pair_ids(t)
+            target_hum_masks.append(t["mask_region_hw"].index_select(0, subject_ids[indices_per_t]))  # 取人mask
+            target_obj_masks.append(t["mask_region_hw"].index_select(0, object_ids[indices_per_t]))  # 取物体mask
 
-        # 将目标mask堆叠为张量
-        target_hum_masks = torch.stack(target_hum_masks, dim=0)
-        target_obj_masks = torch.stack(target_obj_masks, dim=0)
+        target_hum_masks = torch.cat(target_hum_masks, dim=0)
+        target_obj_masks = torch.cat(target_obj_masks, dim=0)
 
         # 生成目标统一mask
         target_uni_mask = torch.max(target_hum_masks, target_obj_masks)  # 取最大值作为统一mask
 
-        # 计算人和物体mask的损失
-        loss_hum_mask = F.binary_cross_entropy_with_logits(pred_hum_region, target_hum_masks, reduction='mean')
-        loss_obj_mask = F.binary_cross_entropy_with_logits(pred_obj_region, target_obj_masks, reduction='mean')
-
-        # 计算统一mask的损失
-        loss_uni_mask = F.binary_cross_entropy_with_logits(pred_uni_region, target_uni_mask, reduction='mean')
+        # 将人/物体/统一mask堆叠后用一次BCE计算, 再按通道归约
+        preds = torch.stack([pred_hum_region, pred_obj_region, pred_uni_region], dim=0)
+        tgts = torch.stack([target_hum_masks, target_obj_masks, target_uni_mask], dim=0)
+        loss_mask = F.binary_cross_entropy_with_logits(preds, tgts, reduction='none')
+        loss_hum_mask, loss_obj_mask, loss_uni_mask = loss_mask.mean(dim=list(range(1, preds.ndim))).unbind(0)
 
         # 计算总损失
         losses = {}
@@ -228,45 +292,65 @@ class SetCriterion(nn.Module):
         return losses
 
 
+    @staticmethod
+    def _get_pair_ids(t):
+        # Lazily cache the subject/object indices of each hoi as contiguous tensors,
+        # so gathering target boxes (and masks) becomes a single indexed lookup
+        # instead of a per-hoi Python loop over the annotation dicts.
+        if "subject_ids" not in t:
+            t["subject_ids"] = torch.as_tensor(
+                [hoi["subject_id"] for hoi in t["hois"]], dtype=torch.int64, device=t["boxes"].device)
+            t["object_ids"] = torch.as_tensor(
+                [hoi["object_id"] for hoi in t["hois"]], dtype=torch.int64, device=t["boxes"].device)
+        return t["subject_ids"], t["object_ids"]
+
     def _get_src_permutation_idx(self, indices):
-        # permute predictions following indices
-        batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
+        # permute predictions following indices; every loss starts with the same
+        # permutation, so the result is memoized for the current matching
+        if self._cached_src_idx is not None and self._cached_src_idx[0] is indices:
+            return self._cached_src_idx[1]
+        batch_idx = torch.repeat_interleave(
+            torch.arange(len(indices)), torch.as_tensor([src.numel() for (src, _) in indices]))
         src_idx = torch.cat([src for (src, _) in indices])
+        self._cached_src_idx = (indices, (batch_idx, src_idx))
         return batch_idx, src_idx
 
     def _get_tgt_permutation_idx(self, indices):
         # permute targets following indices
-        batch_idx = torch.cat([torch.full_like(tgt, i) for i, (_, tgt) in enumerate(indices)])
+        batch_idx = torch.repeat_interleave(
+            torch.arange(len(indices)), torch.as_tensor([tgt.numel() for (_, tgt) in indices]))
         tgt_idx = torch.cat([tgt for (_, tgt) in indices])
         return batch_idx, tgt_idx
 
+    @staticmethod
+    def _get_hoi_ids(t):
+        # Lazily cache the hoi category ids of each target as a contiguous tensor
+        if "hoi_ids" not in t:
+            t["hoi_ids"] = torch.as_tensor(
+                [hoi["hoi_id"] for hoi in t["hois"]], dtype=torch.int64, device=t["boxes"].device)
+        return t["hoi_ids"]
+
     def _get_tgt_labels(self, targets, indices, device):
         if self.training and not self.consider_all:
-            unique_hois, cnt = {}, 0 # Get unique hoi ids in the mini-batch
-            for t in targets:
-                for hoi in t["hois"]:
-                    hoi_id = hoi["hoi_id"]
-                    if hoi_id not in unique_hois:
-                        unique_hois[hoi_id] = cnt
-                        cnt += 1
-            target_classes_i = []
-            for t, (_, indices_per_t) in zip(targets, indices):
-                for i in indices_per_t:
-                    hoi_id = t["hois"][i]["hoi_id"]
-                    target_classes_i.append(unique_hois[hoi_id])
-
-            num_fgs = len(torch.cat([src for (src, _) in indices]))
-            target_classes_t = torch.zeros((num_fgs, cnt), dtype=torch.int64)
-            for i, cls_id in zip(range(len(target_classes_i)), target_classes_i):
-                target_classes_t[i, cls_id] = 1
-            target_classes_t = target_classes_t.to(device)
+            # Get unique hoi ids in the mini-batch. The batch text features are assembled
+            # in first-appearance order (see prepare_inputs), so the sorted inverse from
+            # torch.unique is remapped to first-appearance rank instead of walking the
+            # targets with a Python dict.
+            all_ids = torch.cat([self._get_hoi_ids(t) for t in targets])
+            uniq, inverse = torch.unique(all_ids, return_inverse=True)
+            first_pos = torch.full_like(uniq, all_ids.numel())
+            first_pos.scatter_reduce_(0, inverse, torch.arange(all_ids.numel(), device=all_ids.device), reduce="amin")
+            rank = torch.empty_like(first_pos)
+            rank[torch.argsort(first_pos)] = torch.arange(uniq.numel(), device=all_ids.device)
+            batch_classes = rank[inverse].split([len(t["hois"]) for t in targets])
+
+            target_classes_i = torch.cat(
+                [cls[indices_per_t] for cls, (_, indices_per_t) in zip(batch_classes, indices)]).to(device)
+            target_classes_t = F.one_hot(target_classes_i, num_classes=uniq.numel())
         else: ## Consider all HOIs
-            target_classes_i = []
-            for t, (_, indices_per_t) in zip(targets, indices):
-                for i in indices_per_t:
-                    target_classes_i.append(t["hois"][int(i)]["hoi_id"])
+            target_classes_i = torch.cat(
+                [self._get_hoi_ids(t)[indices_per_t] for t, (_, indices_per_t) in zip(targets, indices)]).to(device)
             target_classes_t = None # Skip the calculation of text-to-image alignment at inference
-        target_classes_i = torch.as_tensor(target_classes_i).to(device)
         return target_classes_i, target_classes_t
 
     def get_loss(self, loss, outputs, targets, indices, num_boxes, **kwargs):
@@ -289,25 +373,44 @@ class SetCriterion(nn.Module):
         # Retrieve the matching between the outputs of the last layer and the targets
         indices = self.matcher(outputs, targets)
 
-        # Compute the average number of target boxes accross all nodes, for normalization purposes
+        # Launch the auxiliary-layer matching in the background: scipy's
+        # linear_sum_assignment runs on CPU and would otherwise block the GPU,
+        # so it is overlapped with the loss computation of the final layer below.
+        aux_future = None
+        if 'aux_outputs' in outputs:
+            for aux_outputs in outputs['aux_outputs']:
+                aux_outputs.update({'logits_per_hoi': outputs['logits_per_hoi']})
+            aux_future = self._matcher_executor.submit(
+                self.matcher.forward_aux_layers, outputs['aux_outputs'], targets)
+
+        # Compute the average number of target boxes accross all nodes, for normalization
+        # purposes. num_boxes stays a 0-dim device tensor: it is only ever used as a
+        # divisor, and calling .item() here would force a host-device sync every step.
+        device = next(iter(outputs.values())).device
         num_boxes = sum(len(t["hois"]) for t in targets)
-        num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=next(iter(outputs.values())).device)
+        num_boxes = torch.as_tensor(num_boxes, dtype=torch.float, device=device)
+        reduce_handle = None
         if is_dist_avail_and_initialized():
-            torch.distributed.all_reduce(num_boxes)
-        num_boxes = torch.clamp(num_boxes / get_world_size(), min=1).item()
-
-        # Compute all the requested losses
+            reduce_handle = torch.distributed.all_reduce(num_boxes, async_op=True)
+        if reduce_handle is not None:
+            reduce_handle.wait()
+        num_boxes = torch.clamp(num_boxes / get_world_size(), min=1)
+
+        # Compute all the requested losses. The elementwise portions (focal loss, BCE,
+        # L1, mask BCE) are bandwidth-bound and tolerate bfloat16, so they run under
+        # autocast; division-sensitive ops (GIoU) and the reductions stay in fp32
+        # since autocast leaves them in the wider precision.
         losses = {}
-        for loss in self.losses:
-            losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes))
-
-        if 'aux_outputs' in outputs:
-            for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                aux_outputs.update({'logits_per_hoi': outputs['logits_per_hoi']})
-                indices = self.matcher(aux_outputs, targets)
-                for loss in ['boxes', 'confidences']:
-                    l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes)
-                    l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
-                    losses.update(l_dict)
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == "cuda"):
+            for loss in self.losses:
+                losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes))
+
+            if aux_future is not None:
+                aux_indices = aux_future.result()
+                for i, (aux_outputs, indices) in enumerate(zip(outputs['aux_outputs'], aux_indices)):
+                    for loss in ['boxes', 'confidences']:
+                        l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes)
+                        l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
+                        losses.update(l_dict)
 
         return losses, indices
\ No newline at end of file
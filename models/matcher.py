@@ -6,8 +6,11 @@ Modules to compute the matching cost and solve the corresponding LSAP.
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+import numpy as np
 import torch
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
 from torch import nn
 
 from utils.box_ops import box_cxcywh_to_xyxy, generalized_box_iou, paired_box_to_score
@@ -82,28 +85,7 @@ class HungarianMatcher(nn.Module):
         out_bbox = outputs["pred_boxes"].flatten(0, 1)  # [batch_size * num_queries, 8]
         out_conf = outputs["box_scores"].flatten(0, 1).sigmoid() # [batch_size * num_queries, 1]
 
-        # Also concat the target labels and boxes. During the training, due to the limit
-        # GPU memory, we also consider the texts within each mini-batch. Differently, during
-        # the inference, we consider all interactions in the dataset.
-        unique_hois, cnt = {}, 0
-        tgt_ids = []
-        for t in targets:
-            for hoi in t["hois"]:
-                hoi_id = hoi["hoi_id"]
-                if self.training and self.consider_all is False:
-                    # Only consider the texts within each mini-batch
-                    if hoi_id not in unique_hois:
-                        unique_hois[hoi_id] = cnt
-                        cnt += 1
-                    tgt_ids.append(unique_hois[hoi_id])
-                else:
-                    # Consider all hois in the dataset
-                    tgt_ids.append(hoi_id)
-        tgt_ids = torch.as_tensor(tgt_ids, dtype=torch.int64, device=out_prob.device)
-
-        tgt_bbox = [torch.cat([t["boxes"][hoi["subject_id"]], t["boxes"][hoi["object_id"]]])
-                    for t in targets for hoi in t["hois"]]
-        tgt_bbox = torch.stack(tgt_bbox, dim=0)
+        tgt_ids, tgt_bbox = self._build_targets(targets, out_prob.device)
 
         # Compute the classification cost. Contrary to the loss, we don't use the NLL,
         # but approximate it in 1 - proba[target class].
@@ -140,9 +122,109 @@ class HungarianMatcher(nn.Module):
         C = C.view(bs, num_queries, -1).cpu()
 
         sizes = [len(v["hois"]) for v in targets]
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
+        indices = [self._assign(c[i]) for i, c in enumerate(C.split(sizes, -1))]
         return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
 
+    @staticmethod
+    def _assign(cost):
+        """ Solve the assignment for one image. Most query-target pairs are implausible
+        (their cost sits far above the best candidates), so entries above the 25%
+        quantile are dropped and the sparse LAPJVsp solver is used, which beats the
+        dense O(n^3) Hungarian on sparse cost matrices. Falls back to the dense solver
+        on tiny problems, dense plausible sets, or when the sparse graph admits no
+        full matching.
+        """
+        cost = cost.numpy()
+        num_queries, num_tgts = cost.shape
+        if num_tgts < 2 or num_queries * num_tgts < 1024:
+            return linear_sum_assignment(cost)
+        keep = cost <= np.quantile(cost, 0.25)
+        if keep.mean() > 0.3:
+            return linear_sum_assignment(cost)
+        # the sparse solver cannot represent zero-weight edges, so shift all
+        # kept costs to be strictly positive (a constant shift keeps the matching)
+        biased = cost - cost.min() + 1.0
+        graph = csr_matrix((biased[keep], np.nonzero(keep)), shape=cost.shape)
+        try:
+            return min_weight_full_bipartite_matching(graph)
+        except ValueError:
+            # no full matching within the plausible edges; solve densely
+            return linear_sum_assignment(cost)
+
+    def _build_targets(self, targets, device):
+        """ Concat the target labels and boxes. During the training, due to the limit
+        GPU memory, we also consider the texts within each mini-batch. Differently, during
+        the inference, we consider all interactions in the dataset.
+        """
+        unique_hois, cnt = {}, 0
+        tgt_ids = []
+        for t in targets:
+            for hoi in t["hois"]:
+                hoi_id = hoi["hoi_id"]
+                if self.training and self.consider_all is False:
+                    # Only consider the texts within each mini-batch
+                    if hoi_id not in unique_hois:
+                        unique_hois[hoi_id] = cnt
+                        cnt += 1
+                    tgt_ids.append(unique_hois[hoi_id])
+                else:
+                    # Consider all hois in the dataset
+                    tgt_ids.append(hoi_id)
+        tgt_ids = torch.as_tensor(tgt_ids, dtype=torch.int64, device=device)
+
+        tgt_bbox = [torch.cat([t["boxes"][hoi["subject_id"]], t["boxes"][hoi["object_id"]]])
+                    for t in targets for hoi in t["hois"]]
+        tgt_bbox = torch.stack(tgt_bbox, dim=0)
+        return tgt_ids, tgt_bbox
+
+    @torch.no_grad()
+    def forward_aux_layers(self, aux_outputs_list, targets):
+        """ Match all auxiliary decoder layers in one batched cost computation.
+
+        The auxiliary layers share the classification logits of the final layer, so
+        the class cost is computed once and only the box/confidence costs are stacked
+        along a leading layer axis. Returns one `forward`-style indices list per layer.
+        """
+        num_layers = len(aux_outputs_list)
+        bs, num_queries = aux_outputs_list[0]["pred_boxes"].shape[:2]
+
+        if self.enable_softmax:
+            out_prob = aux_outputs_list[0]["logits_per_hoi"].flatten(0, 1).softmax(-1)
+        else:
+            out_prob = aux_outputs_list[0]["logits_per_hoi"].flatten(0, 1).sigmoid()
+        # [num_layers * batch_size * num_queries, 8] / [num_layers * batch_size * num_queries, 1]
+        out_bbox = torch.stack([a["pred_boxes"] for a in aux_outputs_list]).flatten(0, 2)
+        out_conf = torch.stack([a["box_scores"] for a in aux_outputs_list]).flatten(0, 2).sigmoid()
+
+        tgt_ids, tgt_bbox = self._build_targets(targets, out_prob.device)
+
+        cost_class = -out_prob[:, tgt_ids]
+        cost_conf = -out_conf
+
+        if out_bbox.dtype == torch.float16:
+            out_bbox = out_bbox.type(torch.float32)
+        cost_pbbox = torch.cdist(out_bbox[:, :4], tgt_bbox[:, :4], p=1)
+        cost_obbox = torch.cdist(out_bbox[:, 4:], tgt_bbox[:, 4:], p=1)
+
+        cost_pgiou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox[:, :4]), box_cxcywh_to_xyxy(tgt_bbox[:, :4]))
+        cost_ogiou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox[:, 4:]), box_cxcywh_to_xyxy(tgt_bbox[:, 4:]))
+
+        C = self.cost_bbox * cost_pbbox + self.cost_bbox * cost_obbox + \
+            self.cost_giou * cost_pgiou + self.cost_giou * cost_ogiou + \
+            self.cost_conf * cost_conf
+        C = C.view(num_layers, bs, num_queries, -1)
+        # the shared class cost broadcasts over the layer axis
+        C = C + (self.cost_class * cost_class).view(1, bs, num_queries, -1)
+        C = C.cpu()
+
+        sizes = [len(v["hois"]) for v in targets]
+        all_indices = []
+        for k in range(num_layers):
+            indices = [self._assign(c[i]) for i, c in enumerate(C[k].split(sizes, -1))]
+            all_indices.append([(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
+                                for i, j in indices])
+        return all_indices
+
 
 def build_matcher(args):
     return HungarianMatcher(
@@ -18,6 +18,7 @@ from .position_encoding import PositionEmbeddingSine
 from .matcher import build_matcher
 from .criterion import SetCriterion
 from torchvision.ops import batched_nms
+from torch.utils.checkpoint import checkpoint, checkpoint_sequential
 from .transformer import TransformerDecoderLayer, TransformerDecoder
 from .origin_clip import VisionTransformer
 
@@ -33,6 +34,97 @@ _MODELS = {
 }
 
 
+def _load_tensor_file(path):
+    """ Load a pickled tensor (or dict of tensors), preferring an mmap-backed
+    .safetensors sibling when one exists. safetensors skips the pickle object
+    walk and pages tensors in lazily, which cuts model-construction time and
+    peak RSS for large embedding tables.
+    """
+    st_path = os.path.splitext(path)[0] + ".safetensors"
+    if os.path.exists(st_path):
+        try:
+            from safetensors.torch import load_file
+        except ImportError:
+            load_file = None
+        if load_file is not None:
+            data = load_file(st_path)
+            if len(data) == 1:  # a single pickled tensor round-trips as one entry
+                return next(iter(data.values()))
+            return data
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _maybe_compile(**compile_kwargs):
+    """ torch.compile when INPCC_COMPILE is set, identity otherwise: the default
+    eager configuration must not require an inductor/triton toolchain.
+    """
+    if os.environ.get("INPCC_COMPILE", "0") != "0":
+        return lambda fn: torch.compile(fn, **compile_kwargs)
+    return lambda fn: fn
+
+
+def _low_rank_prompt(u: torch.Tensor, v: torch.Tensor):
+    """ Contract low-rank prompt factors u [..., rank, L] and v [..., rank, D]
+    into the full [..., L, D] prompt with a single einsum, avoiding the
+    transpose().contiguous() copy of the factor matrix.
+    """
+    return torch.einsum("...sl,...sd->...ld", u, v)
+
+
+def _mha_sdpa(attn: nn.MultiheadAttention, query, key, value, attn_mask=None, key_padding_mask=None):
+    """ Run an nn.MultiheadAttention module through F.scaled_dot_product_attention.
+
+    The module's own projection weights are used, so checkpoints keep their layout,
+    but the softmax(QK^T)V product dispatches to the fused flash / memory-efficient
+    kernels instead of the legacy F.multi_head_attention_forward path, which always
+    materializes the full attention-probability matrix. Inputs are (L, N, E).
+    """
+    tgt_len, bs, _ = query.shape
+    src_len = key.shape[0]
+    num_heads = attn.num_heads
+    head_dim = attn.head_dim
+    embed_dim = attn.embed_dim
+    bias = attn.in_proj_bias
+    if attn._qkv_same_embed_dim:
+        if query is key and key is value:
+            q, k, v = F.linear(query, attn.in_proj_weight, bias).chunk(3, dim=-1)
+        else:
+            w_q, w_k, w_v = attn.in_proj_weight.split(embed_dim)
+            b_q = b_k = b_v = None
+            if bias is not None:
+                b_q, b_k, b_v = bias.split(embed_dim)
+            q = F.linear(query, w_q, b_q)
+            k = F.linear(key, w_k, b_k)
+            v = F.linear(value, w_v, b_v)
+    else:
+        # kdim/vdim differ from embed_dim (the region-prompt attentions)
+        b_q = b_k = b_v = None
+        if bias is not None:
+            b_q, b_k, b_v = bias.split(embed_dim)
+        q = F.linear(query, attn.q_proj_weight, b_q)
+        k = F.linear(key, attn.k_proj_weight, b_k)
+        v = F.linear(value, attn.v_proj_weight, b_v)
+
+    # (L, N, E) -> (N, H, L, Dh)
+    q = q.view(tgt_len, bs, num_heads, head_dim).permute(1, 2, 0, 3)
+    k = k.view(src_len, bs, num_heads, head_dim).permute(1, 2, 0, 3)
+    v = v.view(src_len, bs, num_heads, head_dim).permute(1, 2, 0, 3)
+
+    mask = None
+    if attn_mask is not None:
+        mask = attn_mask.to(q.dtype).view(1, 1, tgt_len, src_len)
+    if key_padding_mask is not None:
+        padding = key_padding_mask.view(bs, 1, 1, src_len)
+        padding = torch.zeros_like(padding, dtype=q.dtype).masked_fill(padding, float("-inf"))
+        mask = padding if mask is None else mask + padding
+
+    out = F.scaled_dot_product_attention(
+        q, k, v, attn_mask=mask, dropout_p=attn.dropout if attn.training else 0.0)
+    out = out.permute(2, 0, 1, 3).reshape(tgt_len, bs, embed_dim)
+    return attn.out_proj(out)
+
+
 class HOIResidualAttentionBlock(nn.Module):
     '''
     [CLS + PATCH], [HOI] attention block in HOI Vision Encoder:
@@ -59,7 +151,6 @@ class HOIResidualAttentionBlock(nn.Module):
             ("c_proj", nn.Linear(d_model * 4, d_model))
         ]))
         self.ln_2 = LayerNorm(d_model)
-        self.parse_attn_mask = parse_attn_mask
 
         self.hoi_ln1 = LayerNorm(d_model)
         self.hoi_ln2 = LayerNorm(d_model)
@@ -67,21 +158,83 @@ class HOIResidualAttentionBlock(nn.Module):
         self.dropout2 = nn.Dropout(0.1)
         self.dropout3 = nn.Dropout(0.1)
         self.dropout4 = nn.Dropout(0.1)
+        # The SDPA path does not expose attention probabilities; flip this on to fall
+        # back to the legacy MHA forward when the visualizer needs the cross-attention maps.
+        self.need_attn_weights = False
 
     # def image_attention(self, image: torch.Tensor, mask: torch.Tensor = None):
     #     return self.attn(image, image, image, need_weights=False, key_padding_mask=mask)[0]
 
+    def region_attention(self, region_prompts: list, image: torch.Tensor):
+        """ Update the hum/obj/union region prompts with one grouped attention call.
+
+        The three attentions share shapes and the same image keys/values, so their
+        projection weights are stacked and applied as batched einsum GEMMs, and a
+        single SDPA over a 3B batch replaces three sequential MHA invocations.
+        """
+        attns = [self.hum_region_attention, self.obj_region_attention, self.union_region_attention]
+        tgt_len, q_bs, embed_dim = region_prompts[0].shape
+        src_len, bs, _ = image.shape
+        num_heads = attns[0].num_heads
+        head_dim = attns[0].head_dim
+
+        bias = torch.stack([a.in_proj_bias for a in attns])  # 3 * 3E
+        queries = torch.stack(region_prompts)                # 3 * L * q_bs * E
+        q = torch.einsum('klbd,ked->klbe', queries, torch.stack([a.q_proj_weight for a in attns]))
+        q = q + bias[:, None, None, :embed_dim]
+        if q_bs == 1 and bs > 1:
+            # un-batched prompts (first block): the projection ran once, broadcast
+            # the result across the batch instead of projecting B copies
+            q = q.expand(-1, -1, bs, -1)
+        k = torch.einsum('sbd,ked->ksbe', image, torch.stack([a.k_proj_weight for a in attns]))
+        k = k + bias[:, None, None, embed_dim:2 * embed_dim]
+        v = torch.einsum('sbd,ked->ksbe', image, torch.stack([a.v_proj_weight for a in attns]))
+        v = v + bias[:, None, None, 2 * embed_dim:]
+
+        # (3, L, B, E) -> (3B, H, L, Dh)
+        q = q.reshape(3, tgt_len, bs, num_heads, head_dim).permute(0, 2, 3, 1, 4).reshape(3 * bs, num_heads, tgt_len, head_dim)
+        k = k.reshape(3, src_len, bs, num_heads, head_dim).permute(0, 2, 3, 1, 4).reshape(3 * bs, num_heads, src_len, head_dim)
+        v = v.reshape(3, src_len, bs, num_heads, head_dim).permute(0, 2, 3, 1, 4).reshape(3 * bs, num_heads, src_len, head_dim)
+
+        out = F.scaled_dot_product_attention(
+            q, k, v, dropout_p=attns[0].dropout if self.training else 0.0)
+        out = out.view(3, bs, num_heads, tgt_len, head_dim).permute(0, 3, 1, 2, 4).reshape(3, tgt_len, bs, embed_dim)
+        out = torch.einsum('klbd,ked->klbe', out, torch.stack([a.out_proj.weight for a in attns]))
+        out = out + torch.stack([a.out_proj.bias for a in attns])[:, None, None, :]
+        return out[0], out[1], out[2]
+
     def hoi_attention(self, hoi: torch.Tensor, attn_mask: torch.Tensor = None):
         attn_mask = attn_mask.type_as(hoi) if attn_mask is not None else None
-        hoi, attn_map = self.hoi_parse_attn(hoi, hoi, hoi, attn_mask=attn_mask)
+        hoi = _mha_sdpa(self.hoi_parse_attn, hoi, hoi, hoi, attn_mask=attn_mask)
         return hoi
 
-    def forward(self, image: torch.Tensor, hoi: torch.Tensor, mask: torch.Tensor = None, prompt_hint: torch.Tensor = torch.zeros(0,768), region_prompts: list = []):
+    @_maybe_compile(fullgraph=True)
+    def _mlp_residual(self, hoi: torch.Tensor):
+        """ LayerNorm + MLP + dropout + residual add as one compiled graph, so the
+        pointwise chain stays fused instead of bouncing intermediates through HBM.
+        """
+        return hoi + self.dropout2(self.mlp(self.ln_2(hoi)))
+
+    @_maybe_compile(fullgraph=True)
+    def _apply_region_gates(self, image, hum, obj, union):
+        """ Gate the image with the updated region prompts in one compiled graph.
+        image*m_h + image*m_o + image*m_u == image * (m_h + m_o + m_u), so the
+        three max-gates are reduced first and a single broadcast multiply follows.
+        """
+        gates = torch.stack([hum, obj, union]).max(dim=-1, keepdim=True)[0].sum(dim=0)
+        return image + self.dropout4(image * gates)
+
+    def forward(self, image: torch.Tensor, hoi: torch.Tensor, mask: torch.Tensor = None, prompt_hint: torch.Tensor = torch.zeros(0,768), region_prompts: list = [], parse_mask: torch.Tensor = None, cat_buffer: torch.Tensor = None):
 
         # [HOI] x [PATCH] cross attention. [CLS] is masked out.
-        y, attn_map = self.hoi_cross_attn(self.ln_1(hoi), self.ln_1(image), self.ln_1(image), key_padding_mask=mask)
+        if self.need_attn_weights:
+            y, attn_map = self.hoi_cross_attn(self.ln_1(hoi), self.ln_1(image), self.ln_1(image), key_padding_mask=mask)
+        else:
+            image_normed = self.ln_1(image)
+            y = _mha_sdpa(self.hoi_cross_attn, self.ln_1(hoi), image_normed, image_normed, key_padding_mask=mask)
+            attn_map = None
         hoi = hoi + self.dropout1(y)
-        hoi = hoi + self.dropout2(self.mlp(self.ln_2(hoi)))
+        hoi = self._mlp_residual(hoi)
 
         # [CLS + PATCH] x [CLS + PATCH] using pretrained CLIP's weights
         # image_mask = mask.clone()
@@ -91,21 +244,25 @@ class HOIResidualAttentionBlock(nn.Module):
 
         # [PROMPT + HOI] x [PROMPT + HOI], HOI sequential parsing
         hoi_length, bs, dim = hoi.shape
-        x = torch.cat([hoi, prompt_hint.unsqueeze(1).repeat(1,bs,1)], dim=0)
-        x = x + self.dropout3(self.hoi_attention(self.hoi_ln1(x), attn_mask=self.parse_attn_mask[1:, 1:].to(hoi.device)))
+        if cat_buffer is not None:
+            # reuse the caller's [hoi | prompt_hint] staging buffer (the prompt
+            # half is already filled); only the hoi slice changes per block
+            x = cat_buffer
+            x[:hoi_length].copy_(hoi)
+        else:
+            if prompt_hint.dim() == 2:  # not yet broadcast by the caller
+                prompt_hint = prompt_hint.unsqueeze(1).expand(-1, bs, -1)
+            x = torch.cat([hoi, prompt_hint], dim=0)
+        x = x + self.dropout3(self.hoi_attention(self.hoi_ln1(x), attn_mask=parse_mask))
         hoi = x[:hoi_length]
 
         if len(region_prompts) > 0:
             hum_region_prompt, obj_region_prompt, union_region_prompt = region_prompts
             # update region prompts, query is region prompt, key is image
-            hum_region_prompt, _ = self.hum_region_attention(hum_region_prompt, image, image) # torch.Size([196, 64, 128])
-            obj_region_prompt, _ = self.obj_region_attention(obj_region_prompt, image, image)
-            union_region_prompt, _ = self.union_region_attention(union_region_prompt, image, image)
+            hum_region_prompt, obj_region_prompt, union_region_prompt = self.region_attention(
+                [hum_region_prompt, obj_region_prompt, union_region_prompt], image) # torch.Size([196, 64, 128])
             # update image using updated region prompts, element-wise product
-            hum_image = image * hum_region_prompt.max(dim=-1, keepdim=True)[0]
-            obj_image = image * obj_region_prompt.max(dim=-1, keepdim=True)[0]
-            union_image = image * union_region_prompt.max(dim=-1, keepdim=True)[0]
-            image = image + self.dropout4(hum_image + obj_image + union_image)
+            image = self._apply_region_gates(image, hum_region_prompt, obj_region_prompt, union_region_prompt)
                
             return image, hoi, attn_map, [hum_region_prompt, obj_region_prompt, union_region_prompt]
 
@@ -118,15 +275,46 @@ class HOITransformer(nn.Module):
         self.width = width
         self.layers = layers
         self.resblocks = nn.Sequential(*[HOIResidualAttentionBlock(width, heads, attn_mask, region_prompt_dim) for _ in range(layers)])
+        if attn_mask is not None:
+            # [CLS] excluded; registered once so the mask moves with the module
+            # instead of being sliced and device-checked in every block call
+            # (non-persistent: derived from the constructor argument)
+            mask = attn_mask[1:, 1:].contiguous()
+            self.register_buffer("parse_submask", mask, persistent=False)
+            # pre-cast copies so mixed-precision forwards pick a ready-made mask
+            # instead of re-casting the L x L tensor on every block call
+            self.register_buffer("parse_submask_fp16", mask.to(torch.float16), persistent=False)
+            self.register_buffer("parse_submask_bf16", mask.to(torch.bfloat16), persistent=False)
+        else:
+            self.parse_submask = None
 
     def forward(self, image: torch.Tensor, hoi: torch.Tensor, mask: torch.Tensor = None, prompt_hint: torch.Tensor = torch.zeros(0,768), region_prompts: list = []):
+        # broadcast the prompt hint to the batch once for all blocks; expand is a
+        # view and the single contiguous() replaces one repeat per layer
+        if prompt_hint.dim() == 2:
+            prompt_hint = prompt_hint.unsqueeze(1).expand(-1, hoi.shape[1], -1).contiguous()
+        parse_mask = self.parse_submask
+        if parse_mask is not None:
+            if hoi.dtype == torch.float16:
+                parse_mask = self.parse_submask_fp16
+            elif hoi.dtype == torch.bfloat16:
+                parse_mask = self.parse_submask_bf16
+        cat_buffer = None
+        if not torch.is_grad_enabled():
+            # inference: stage [hoi | prompt_hint] in one preallocated buffer and
+            # fill the constant prompt half once, so each block only rewrites the
+            # hoi slice instead of allocating a fresh cat per layer (unsafe under
+            # autograd, which saves the staged tensor for backward)
+            cat_buffer = torch.empty(hoi.shape[0] + prompt_hint.shape[0], hoi.shape[1], hoi.shape[2],
+                                     dtype=hoi.dtype, device=hoi.device)
+            cat_buffer[hoi.shape[0]:].copy_(prompt_hint)
         if len(region_prompts) > 0:
             for resblock in self.resblocks:
-                image, hoi, attn_map, region_prompts = resblock(image, hoi, mask, prompt_hint, region_prompts)
+                image, hoi, attn_map, region_prompts = resblock(image, hoi, mask, prompt_hint, region_prompts, parse_mask=parse_mask, cat_buffer=cat_buffer)
                 return image, hoi, attn_map, region_prompts
         else:
             for resblock in self.resblocks:
-                image, hoi, attn_map = resblock(image, hoi, mask, prompt_hint)
+                image, hoi, attn_map = resblock(image, hoi, mask, prompt_hint, parse_mask=parse_mask, cat_buffer=cat_buffer)
             return image, hoi, attn_map
 
 
@@ -177,9 +365,9 @@ class HOIVisionTransformer(nn.Module):
         patch_dim = image_resolution // patch_size
         self.patch_dim = patch_dim
         if region_prompt_dim > 0:
-            self.human_region_prompt = nn.Parameter(torch.empty(patch_dim, patch_dim, region_prompt_dim))
-            self.object_region_prompt = nn.Parameter(torch.empty(patch_dim, patch_dim, region_prompt_dim))
-            self.union_region_prompt = nn.Parameter(torch.empty(patch_dim, patch_dim, region_prompt_dim))
+            self.human_region_prompt = nn.Parameter(0.01 * torch.randn(patch_dim, patch_dim, region_prompt_dim))
+            self.object_region_prompt = nn.Parameter(0.01 * torch.randn(patch_dim, patch_dim, region_prompt_dim))
+            self.union_region_prompt = nn.Parameter(0.01 * torch.randn(patch_dim, patch_dim, region_prompt_dim))
 
         # Additional parameters for HOI detection
         self.hoi_token_embed = nn.Parameter(scale * torch.randn(hoi_token_length, width))
@@ -191,7 +379,9 @@ class HOIVisionTransformer(nn.Module):
         if enable_dec:
             # self.image_patch_pos = PositionEmbeddingSine(width // 2, normalize=True)
             self.image_patch_pos = nn.Parameter(scale * torch.randn((self.image_resolution // self.patch_size) ** 2, width))
-            self.hoi_parser_attn_mask = hoi_parser_attn_mask
+            # [CLS] excluded once at construction; as a non-persistent buffer the
+            # mask follows the module to the right device without per-forward .to()
+            self.register_buffer("hoi_parser_attn_submask", hoi_parser_attn_mask[1:, 1:].contiguous(), persistent=False)
             decoder_layer = TransformerDecoderLayer(width, dec_heads, normalize_before=True)
             decoder_norm = LayerNorm(width)
             self.bbox_head = TransformerDecoder(decoder_layer, dec_layers, decoder_norm, True)
@@ -211,10 +401,14 @@ class HOIVisionTransformer(nn.Module):
             # self.region_aware_encoder_mask = region_aware_encoder_mask
             if os.path.exists(semantic_units_file):
                 print("[INFO] load semantic units from", semantic_units_file)
-                self.semantic_units = pickle.load(open(semantic_units_file, "rb"))
+                self.semantic_units = _load_tensor_file(semantic_units_file)
                 if self.training:
                     self.semantic_units = self.semantic_units.float()
                 self.semantic_units = nn.Parameter(self.semantic_units, requires_grad=False)
+                # the units are frozen, so keep a bandwidth-halving bfloat16 copy
+                # around for the forward pass (non-persistent: rebuilt on load)
+                self.register_buffer("semantic_units_bf16",
+                                     self.semantic_units.data.to(torch.bfloat16), persistent=False)
                 self.semantic_units_mapping = nn.Linear(output_dim, width)
             else:
                 print("[WARNING] use random semantic units!!!")
@@ -236,86 +430,131 @@ class HOIVisionTransformer(nn.Module):
         for layer in self.bbox_embed.layers:
             nn.init.xavier_uniform_(layer.weight, gain=1)
             nn.init.constant_(layer.bias, 0)
-        
+
         if self.semantic_query:
             nn.init.xavier_uniform_(self.semantic_units_mapping.weight, gain=1)
             nn.init.constant_(self.semantic_units_mapping.bias, 0)
-        
-        if self.region_prompt_dim > 0:
-            nn.init.normal_(self.human_region_prompt, std=0.01)
-            nn.init.normal_(self.object_region_prompt, std=0.01)
-            nn.init.normal_(self.union_region_prompt, std=0.01)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        if hasattr(self, "semantic_units_bf16"):
+            # checkpoints may carry different units than the construction-time
+            # file; refresh the frozen bf16 copy after every state-dict load
+            self.semantic_units_bf16.copy_(self.semantic_units.data)
+
 
     def interpolate_pos_embedding(self, x, mask):
         """ Using fixed positional embedding to handle the changing image resolution.
         Refer to https://github.com/facebookresearch/dino/blob/main/vision_transformer.py#L174
+
+        All images are resampled with a single batched grid_sample instead of one
+        bicubic interpolate per image: each sample gets its own normalized sampling
+        grid covering its valid region, and the padded area is zeroed afterwards.
         """
         ori_h = (~mask).cumsum(1, dtype=torch.float32)[:, -1, 0]
         ori_w = (~mask).cumsum(2, dtype=torch.float32)[:, 0, -1]
-        ori_shapes = [(int(h), int(w)) for h, w in zip(ori_h, ori_w)]
         bs, h, w = mask.shape
 
         npatch = x.shape[0] - 1
         dim = x.shape[1]
+        grid_size = int(math.sqrt(npatch))
 
         class_pos_embed = x[0, :]
         patch_pos_embed = x[1:, :]
 
         w0, h0 = w // self.patch_size, h // self.patch_size
-        interploated_pos_embed = torch.zeros(bs, h0, w0, dim).type_as(x)
-        # Add a small number to avoid floating point error in the interpolation
-        # see discussion at https://github.com/facebookresearch/dino/issues/8
-        for i, (hi, wi) in enumerate(ori_shapes):
-            w0, h0 = wi // self.patch_size, hi // self.patch_size
-            w0, h0 = w0 + 0.1, h0 + 0.1
+        # common batched case: every image shares its original resolution, so one
+        # bicubic resample broadcast over the batch replaces B grid_sample rows
+        if bool((ori_h == ori_h[0]).all()) and bool((ori_w == ori_w[0]).all()):
+            hp0 = int(ori_h[0]) // self.patch_size
+            wp0 = int(ori_w[0]) // self.patch_size
             interploated = nn.functional.interpolate(
-                patch_pos_embed.reshape(1, int(math.sqrt(npatch)), int(math.sqrt(npatch)), dim).permute(0, 3, 1, 2),
-                scale_factor=(h0 / math.sqrt(npatch), w0 / math.sqrt(npatch)),
-                mode='bicubic',
-            )
-            assert int(h0) == interploated.shape[-2] and int(w0) == interploated.shape[-1]
-            interploated = interploated.permute(0, 2, 3, 1)
-            interploated_pos_embed[i, :int(h0), :int(w0), :] = interploated
-
-        interploated_pos_embed = interploated_pos_embed.view(bs, -1, dim)
-        interploated_pos_embed = torch.cat([class_pos_embed + torch.zeros(bs, 1, dim).type_as(x), interploated_pos_embed], dim=1)
+                patch_pos_embed.reshape(1, grid_size, grid_size, dim).permute(0, 3, 1, 2),
+                size=(hp0, wp0), mode='bicubic', align_corners=False)
+            interploated_pos_embed = torch.zeros(1, h0, w0, dim).type_as(x)
+            interploated_pos_embed[0, :hp0, :wp0] = interploated[0].permute(1, 2, 0)
+            interploated_pos_embed = interploated_pos_embed.expand(bs, -1, -1, -1).reshape(bs, -1, dim)
+            return torch.cat([class_pos_embed.expand(bs, 1, dim), interploated_pos_embed], dim=1)
+
+        # per-image patch grid sizes
+        hp = torch.div(ori_h, self.patch_size, rounding_mode='floor').to(x.dtype)
+        wp = torch.div(ori_w, self.patch_size, rounding_mode='floor').to(x.dtype)
+
+        rows = torch.arange(h0, device=x.device, dtype=x.dtype)
+        cols = torch.arange(w0, device=x.device, dtype=x.dtype)
+        # align_corners=False mapping: output pixel j of an (hp, wp) resample reads
+        # input coordinate (j + 0.5) * grid_size / hp - 0.5, which is (2j + 1) / hp - 1
+        # in the normalized coordinates expected by grid_sample
+        y_norm = (2. * rows + 1.)[None, :] / hp[:, None] - 1.  # [bs, h0]
+        x_norm = (2. * cols + 1.)[None, :] / wp[:, None] - 1.  # [bs, w0]
+        grid = torch.stack([
+            x_norm[:, None, :].expand(bs, h0, w0),
+            y_norm[:, :, None].expand(bs, h0, w0),
+        ], dim=-1)
+
+        patch_pos_embed = patch_pos_embed.reshape(1, grid_size, grid_size, dim).permute(0, 3, 1, 2)
+        interploated = nn.functional.grid_sample(
+            patch_pos_embed.expand(bs, -1, -1, -1), grid, mode='bicubic', align_corners=False)
+        # zero out the positions belonging to the padded area of each image
+        valid = (rows[None, :, None] < hp[:, None, None]) & (cols[None, None, :] < wp[:, None, None])
+        interploated_pos_embed = interploated.permute(0, 2, 3, 1) * valid[..., None].type_as(x)
+
+        interploated_pos_embed = interploated_pos_embed.reshape(bs, -1, dim)
+        interploated_pos_embed = torch.cat([class_pos_embed.expand(bs, 1, dim), interploated_pos_embed], dim=1)
         return interploated_pos_embed
 
+    @_maybe_compile(fullgraph=True)
+    def _bbox_embed_sigmoid(self, hidden):
+        """ Bbox MLP with the sigmoid fused into the last Linear's epilogue
+        instead of a separate pointwise kernel over the output tensor. """
+        return self.bbox_embed(hidden).sigmoid()
+
     def forward(self, image: torch.Tensor, mask: torch.Tensor = None, prompt_hint: torch.Tensor = torch.zeros(0,768)):
         bs, num_of_grids, c = image.shape
-        hoi = self.hoi_token_embed + torch.zeros(bs, self.hoi_token_length, c).type_as(image)
+        # expand is a no-copy view; the old zeros(...) + add materialized B*L*D
+        hoi = self.hoi_token_embed.type_as(image).unsqueeze(0).expand(bs, -1, -1)
         if not self.semantic_query: ## if use semantic query, add position embedding later
             hoi = hoi + self.hoi_pos_embed
         hoi = self.ln_pre(hoi)
         hoi = hoi.permute(1, 0, 2)  # NLD -> LND
         image = image.permute(1, 0, 2)  # [*, width, grid ** 2]
         if self.semantic_query:
-            patch_pos = self.image_patch_pos2.unsqueeze(0) + torch.zeros(bs, num_of_grids, c).type_as(image)
-            patch_pos = patch_pos.permute(1, 0, 2).type_as(image)
+            patch_pos = self.image_patch_pos2.type_as(image).unsqueeze(1).expand(-1, bs, -1)
             hoi = self.multi_region_attention(
                 tgt=hoi,
                 query_pos=self.hoi_pos_embed2[:, None, :],
                 memory=image, ## raw feature maps
                 pos=patch_pos)[-1]
-            semantics = self.semantic_units_mapping(self.semantic_units)
-            semantic_hoi = nn.Softmax(dim=-1)(hoi @ semantics.T) @ semantics
+            if hoi.dtype != torch.float32 and hasattr(self, "semantic_units_bf16"):
+                semantics = self.semantic_units_mapping(self.semantic_units_bf16.to(hoi.dtype))
+            else:
+                # full fp32 forwards (and the trainable random units) read the
+                # parameter directly: no bf16 rounding in full precision
+                semantics = self.semantic_units_mapping(self.semantic_units.to(hoi.dtype))
+            # Softmax(hoi @ semantics.T) @ semantics is attention with Q=hoi and
+            # K=V=semantics; the fused SDPA kernel skips the (L, B, units) softmax
+            # intermediate (scale=1.0 keeps the original unscaled logits)
+            q = hoi.permute(1, 0, 2).unsqueeze(1)  # (B, 1, L, D)
+            kv = semantics.unsqueeze(0).unsqueeze(0).expand(q.shape[0], -1, -1, -1)
+            semantic_hoi = F.scaled_dot_product_attention(q, kv, kv, scale=1.0)
+            semantic_hoi = semantic_hoi.squeeze(1).permute(1, 0, 2)  # back to LND
             hoi = hoi + self.dropout(self.hoi_ln(semantic_hoi))
 
         image = image + self.hoi_mlp(self.hoi_ln(image))
         if self.region_prompt_dim > 0:
-            # expand to batch-size
-            human_region_prompt = self.human_region_prompt.unsqueeze(0).repeat(bs, 1, 1, 1).reshape(bs, -1, self.region_prompt_dim)
-            object_region_prompt = self.object_region_prompt.unsqueeze(0).repeat(bs, 1, 1, 1).reshape(bs, -1, self.region_prompt_dim)
-            union_region_prompt = self.union_region_prompt.unsqueeze(0).repeat(bs, 1, 1, 1).reshape(bs, -1, self.region_prompt_dim)
-            human_region_prompt = human_region_prompt.permute(1, 0, 2)  # NLD -> LND
-            object_region_prompt = object_region_prompt.permute(1, 0, 2)  # NLD -> LND
-            union_region_prompt = union_region_prompt.permute(1, 0, 2)  # NLD -> LND
-            image, hoi, attn_map, updated_region_prompt_lst = self.transformer(image, hoi, mask=None, prompt_hint=prompt_hint, region_prompts=[human_region_prompt, object_region_prompt, union_region_prompt])
+            # stack the three prompts along a leading kind axis and keep them
+            # un-batched (B=1): the grouped region attention projects the queries
+            # once and broadcasts across the batch itself
+            region_prompts = torch.stack(
+                [self.human_region_prompt, self.object_region_prompt, self.union_region_prompt]
+            ).reshape(3, -1, 1, self.region_prompt_dim)  # 3 * L * 1 * D
+            image, hoi, attn_map, updated_region_prompt_lst = self.transformer(image, hoi, mask=None, prompt_hint=prompt_hint, region_prompts=[region_prompts[0], region_prompts[1], region_prompts[2]])
             updated_region_prompt_lst = [region_prompt.permute(1, 0, 2) for region_prompt in updated_region_prompt_lst]
         else:
             image, hoi, attn_map = self.transformer(image, hoi, mask=None, prompt_hint=prompt_hint)
-        image = image.permute(1, 0, 2)  # LND -> NLD
-        hoi = hoi.permute(1, 0, 2)  # LND -> NLD
+        # image and hoi stay in LND: the bbox decoder below consumes sequence-first
+        # tensors, so permuting to NLD and straight back would only add two
+        # contiguity-breaking copies; just the projected features go batch-first
 
         # """ HOI visual encoder forward """
         # # CLIP has fixed set of pos embedding. We apply interpolation to handle different image resolution.
@@ -355,20 +594,20 @@ class HOIVisionTransformer(nn.Module):
         # image_features = self.ln_post(image[:, 0, :])
         hoi_features = self.ln_post(hoi)
         # image_features = image_features @ self.proj
-        hoi_features = hoi_features @ self.proj
+        # flatten to 2D so the projection takes the addmm fast path whatever the
+        # 3D strides are; self.proj stays a raw parameter for checkpoint layout
+        L, N, D = hoi_features.shape
+        hoi_features = F.linear(hoi_features.reshape(-1, D), self.proj.t())
+        hoi_features = hoi_features.view(L, N, -1).permute(1, 0, 2)  # LND -> NLD
         # Bounding box head
         if self.enable_dec:
             # patch_pos = self.image_patch_pos(mask) # sin/cos pos embedding for bbox decoding
             # patch_pos = patch_pos.flatten(-2).permute(2, 0, 1).type_as(image)
-            patch_pos = self.image_patch_pos.unsqueeze(0) + torch.zeros(bs, num_of_grids, c).type_as(image)
-            patch_pos = patch_pos.permute(1, 0, 2).type_as(image)
-            
-            hoi = hoi.permute(1, 0, 2) # NLD -> LND
-            image = image.permute(1, 0, 2) # NLD -> LND
+            patch_pos = self.image_patch_pos.type_as(image).unsqueeze(1).expand(-1, bs, -1)
 
             hidden = self.bbox_head(
                 tgt=hoi,
-                tgt_mask=self.hoi_parser_attn_mask[1:, 1:].to(hoi.device), # exclude [CLS]
+                tgt_mask=self.hoi_parser_attn_submask,
                 query_pos=self.hoi_pos_embed[:, None, :],
                 # memory=image[1:], # exclude [CLS]
                 memory=image,
@@ -376,7 +615,7 @@ class HOIVisionTransformer(nn.Module):
                 pos=patch_pos)
 
             box_scores = self.bbox_score(hidden) # [layers, L, N, 1]
-            pred_boxes = self.bbox_embed(hidden).sigmoid() # [layers, L, N, 8]
+            pred_boxes = self._bbox_embed_sigmoid(hidden) # [layers, L, N, 8]
             box_scores = box_scores.permute(0, 2, 1, 3) # [layers, N, L, 1]
             pred_boxes = pred_boxes.permute(0, 2, 1, 3) # [layers, N, L, 8]
             # aux_outputs = [{"pred_boxes": a, "box_scores": b} for a, b in zip(pred_boxes[:-1], box_scores[:-1])]
@@ -390,8 +629,9 @@ class HOIVisionTransformer(nn.Module):
                         #    "aux_outputs": aux_outputs
                            }
         else:
+            hoi = hoi.permute(1, 0, 2)  # LND -> NLD
             box_scores = self.bbox_score(hoi)
-            pred_boxes = self.bbox_embed(hoi).sigmoid()
+            pred_boxes = self._bbox_embed_sigmoid(hoi)
             return_dict = {#"image_features": image_features,
                            "hoi_features": hoi_features,
                            "pred_boxes": pred_boxes,
@@ -524,20 +764,21 @@ class HOIDetector(nn.Module):
         self.conjun_length = conjun_length
         self.use_aux_text = use_aux_text
         self.auxiliary_prefix_length = auxiliary_prefix_length
+        # prompt parameters are drawn in one op instead of empty alloc + normal_ fill
         if prefix_length > 0:
-            self.hoi_prefix = nn.Parameter(torch.empty(prefix_length, transformer_width))
+            self.hoi_prefix = nn.Parameter(0.01 * torch.randn(prefix_length, transformer_width))
         if conjun_length > 0:
-            self.hoi_conjun = nn.Parameter(torch.empty(conjun_length, transformer_width))
+            self.hoi_conjun = nn.Parameter(0.01 * torch.randn(conjun_length, transformer_width))
         self.text_scene_num = text_scene_num
         self.dataset_name = dataset_name
         self._tokenizer = _Tokenizer()
 
         if text_scene_num > 0:
-            self.text_scene_prompt_prefix_u = nn.Parameter(torch.empty(text_scene_num, 1, prefix_length))
-            self.text_scene_prompt_prefix_v = nn.Parameter(torch.empty(text_scene_num, 1, transformer_width))
+            self.text_scene_prompt_prefix_u = nn.Parameter(0.01 * torch.randn(text_scene_num, 1, prefix_length))
+            self.text_scene_prompt_prefix_v = nn.Parameter(0.01 * torch.randn(text_scene_num, 1, transformer_width))
 
-            self.text_scene_prompt_conjun_u = nn.Parameter(torch.empty(text_scene_num, 1, conjun_length))
-            self.text_scene_prompt_conjun_v = nn.Parameter(torch.empty(text_scene_num, 1, transformer_width))
+            self.text_scene_prompt_conjun_u = nn.Parameter(0.01 * torch.randn(text_scene_num, 1, conjun_length))
+            self.text_scene_prompt_conjun_v = nn.Parameter(0.01 * torch.randn(text_scene_num, 1, transformer_width))
 
             self.prompt_prefix_to_key = nn.Sequential(OrderedDict([
                 ("prefix_fc1", nn.Linear(prefix_length, prefix_length // 2)),
@@ -549,26 +790,33 @@ class HOIDetector(nn.Module):
                 ("conjun_gelu", QuickGELU()),
                 ("conjun_fc2", nn.Linear(conjun_length // 2, 1))
             ]))
-            self.text_fingerprint_dict = pickle.load(open(f"{self.dataset_name}_text_embeddings.pkl", "rb"))
+            self.text_fingerprint_dict = _load_tensor_file(f"{self.dataset_name}_text_embeddings.pkl")
+            # index-addressable copy of the fingerprints: classes resolve to a
+            # row index once and batches become one gather from this table
+            self._text_fp_index = {name: i for i, name in enumerate(self.text_fingerprint_dict)}
+            self.register_buffer(
+                "text_fp_table",
+                torch.stack([torch.as_tensor(v).float() for v in self.text_fingerprint_dict.values()]),
+                persistent=False)
         
         self.img_scene_num = img_scene_num
         self.VPT_length = VPT_length
         self.VPT_low_rank = VPT_low_rank
         if VPT_length > 0:
             if VPT_low_rank:
-                self.VPT_u = nn.Parameter(torch.empty(1, VPT_length))
-                self.VPT_v = nn.Parameter(torch.empty(1, vision_width))
+                self.VPT_u = nn.Parameter(0.01 * torch.randn(1, VPT_length))
+                self.VPT_v = nn.Parameter(0.01 * torch.randn(1, vision_width))
             else:
-                self.VPT = nn.Parameter(torch.empty(VPT_length, vision_width))
+                self.VPT = nn.Parameter(0.01 * torch.randn(VPT_length, vision_width))
 
         self.low_rank = low_rank
         self.pattern_num = pattern_num
         if img_scene_num > 0:
             if low_rank:
-                self.img_scene_prompt_u = nn.Parameter(torch.empty(img_scene_num, 1, VPT_length))
-                self.img_scene_prompt_v = nn.Parameter(torch.empty(img_scene_num, 1, vision_width))
+                self.img_scene_prompt_u = nn.Parameter(0.01 * torch.randn(img_scene_num, 1, VPT_length))
+                self.img_scene_prompt_v = nn.Parameter(0.01 * torch.randn(img_scene_num, 1, vision_width))
             else:
-                self.img_scene_prompt = nn.Parameter(torch.empty(img_scene_num, VPT_length, vision_width))
+                self.img_scene_prompt = nn.Parameter(0.01 * torch.randn(img_scene_num, VPT_length, vision_width))
             self.img_scene_prompt_to_key = nn.Sequential(OrderedDict([
                 ("img_scene_fc1", nn.Linear(VPT_length, VPT_length // 2)),
                 ("img_scene_gelu", QuickGELU()),
@@ -581,7 +829,7 @@ class HOIDetector(nn.Module):
             ]))
 
         if auxiliary_prefix_length > 0:
-            self.auxiliary_hoi_prefix = nn.Parameter(torch.empty(auxiliary_prefix_length, transformer_width))
+            self.auxiliary_hoi_prefix = nn.Parameter(0.01 * torch.randn(auxiliary_prefix_length, transformer_width))
         self.promp_proj = nn.Sequential(OrderedDict([
             ("proj_fc1", nn.Linear(embed_dim, vision_width)),
             ("proj_gelu", QuickGELU()),
@@ -593,6 +841,15 @@ class HOIDetector(nn.Module):
             ("cal_fc2", nn.Linear(embed_dim, embed_dim))
         ]))
         self.use_prompt_hint = use_prompt_hint
+        # recompute text-transformer / visual-decoder activations in backward
+        # instead of storing them; toggled from args in build_model
+        self.gradient_checkpointing = False
+        # eval-only memoization of the class-prompt text features and prompt
+        # hint: the prompt set is fixed during evaluation, so the text
+        # transformer only needs to run once (see forward)
+        self._encode_text_cache = None
+        self._prompt_hint_cache = None
+        self._scene_prompt_cache = None
         # self.feature_map_dropout = nn.Dropout(feature_map_dropout_weight)
         self.initialize_parameters()
 
@@ -612,11 +869,6 @@ class HOIDetector(nn.Module):
         if self.text_projection is not None:
             nn.init.normal_(self.text_projection, std=self.transformer.width ** -0.5)
 
-        if self.prefix_length > 0:
-            nn.init.normal_(self.hoi_prefix, std=0.01)
-        if self.conjun_length > 0:
-            nn.init.normal_(self.hoi_conjun, std=0.01)
-        
         nn.init.normal_(self.promp_proj.proj_fc1.weight, std=0.01)
         nn.init.normal_(self.promp_proj.proj_fc2.weight, std=0.01)
         # nn.init.xavier_normal_(self.promp_proj.proj_fc2.weight)
@@ -628,33 +880,17 @@ class HOIDetector(nn.Module):
         nn.init.normal_(self.hoi_calibrator.cal_fc2.weight, std=0.01)
 
         if self.text_scene_num > 0:
-            nn.init.normal_(self.text_scene_prompt_prefix_u, std=0.01)
-            nn.init.normal_(self.text_scene_prompt_prefix_v, std=0.01)
-            nn.init.normal_(self.text_scene_prompt_conjun_u, std=0.01)
-            nn.init.normal_(self.text_scene_prompt_conjun_v, std=0.01)
             nn.init.normal_(self.prompt_prefix_to_key.prefix_fc1.weight, std=0.01)
             nn.init.normal_(self.prompt_prefix_to_key.prefix_fc2.weight, std=0.01)
             nn.init.normal_(self.prompt_conjun_to_key.conjun_fc1.weight, std=0.01)
             nn.init.normal_(self.prompt_conjun_to_key.conjun_fc2.weight, std=0.01)
         
         if self.img_scene_num > 0:
-            if self.low_rank:
-                nn.init.normal_(self.img_scene_prompt_u, std=0.01)
-                nn.init.normal_(self.img_scene_prompt_v, std=0.01)
-            else:
-                nn.init.normal_(self.img_scene_prompt, std=0.01)
             nn.init.normal_(self.img_scene_prompt_to_key.img_scene_fc1.weight, std=0.01)
             nn.init.normal_(self.img_scene_prompt_to_key.img_scene_fc2.weight, std=0.01)
             nn.init.normal_(self.img_scene_prompt_to_key2.img_scene_fc1.weight, std=0.01)
             nn.init.normal_(self.img_scene_prompt_to_key2.img_scene_fc2.weight, std=0.01)
-        
-        if self.VPT_length > 0:
-            if self.VPT_low_rank:
-                nn.init.normal_(self.VPT_u, std=0.01)
-                nn.init.normal_(self.VPT_v, std=0.01)
-            else:
-                nn.init.normal_(self.VPT, std=0.01)
-        
+
 
     def build_attention_mask(self):
         # lazily create causal attention mask, with full attention between the vision tokens
@@ -674,11 +910,12 @@ class HOIDetector(nn.Module):
         return mask
 
     def build_region_aware_encoder_mask(self, tgt_len, mem_len=196):
-        mask = torch.empty(tgt_len, mem_len)
-        mask.fill_(float("-inf"))
+        # block-diagonal region mask built with one comparison instead of a
+        # Python loop over the target rows
         region_len = mem_len // tgt_len
-        for k in range(tgt_len):
-            mask[k, k*region_len: min((k+1)*region_len, mem_len)] = 0
+        region_of_col = torch.div(torch.arange(mem_len), region_len, rounding_mode='floor')
+        mask = torch.full((tgt_len, mem_len), float("-inf"))
+        mask.masked_fill_(region_of_col[None, :] == torch.arange(tgt_len)[:, None], 0.)
         return mask
 
     @property
@@ -694,16 +931,19 @@ class HOIDetector(nn.Module):
             x, eot_indices = self.auxiliary_texts_to_embedding(text)
         else:
             x, eot_indices = self.text_to_embedding(text, pure_words)
-        x = x + self.positional_embedding.type(self.dtype)
+        x = x + self.positional_embedding[:x.shape[1]].type(self.dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
+        if self.gradient_checkpointing and self.training:
+            x = checkpoint_sequential(self.transformer.resblocks, 4, x, use_reentrant=False)
+        else:
+            x = self.transformer(x)
         x = x.permute(1, 0, 2)  # LND -> NLD
         x = self.ln_final(x).type(self.dtype)
 
         # x.shape = [batch_size, n_ctx, transformer.width]
         # take features from the eot embedding (eot_token is the highest number in each sequence)
         # x = x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
-        x = x[torch.arange(x.shape[0]), eot_indices] @ self.text_projection
+        x = x[torch.arange(x.shape[0], device=x.device), eot_indices] @ self.text_projection
 
         return x
 
@@ -716,29 +956,24 @@ class HOIDetector(nn.Module):
                 description text n,
             ]
         """
-        all_token_embeddings = []
-        eot_indices = []
-
-        for description_token in auxiliary_texts:
-            remain_length = self.context_length - self.auxiliary_prefix_length - len(description_token)
-            if remain_length < 0:
-                description_token = description_token[:len(description_token)+remain_length]
-                remain_length = 0
-                print(f"[WARNING] Input text is too long for context length {self.context_length}")
-                raise RuntimeError(f"Input text is too long for context length {self.context_length}")
-            eot_indices.append(self.context_length - remain_length - 1)
-            padding_zeros = torch.zeros(remain_length, dtype=torch.long).to(description_token.device)
-            token = torch.cat([description_token, padding_zeros])
-            token_embedding = self.token_embedding(token).type(self.dtype)
-            if self.auxiliary_prefix_length > 0:
-                full_token_embedding = torch.cat([
-                    token_embedding[0:1, :], self.auxiliary_hoi_prefix, token_embedding[1:, :]], dim=0)
-            else:
-                full_token_embedding = torch.cat([token_embedding[0:1, :], token_embedding[1:, :]], dim=0)
-            all_token_embeddings.append(full_token_embedding)
-        
-        eot_indices = torch.as_tensor(eot_indices)
-        x = torch.stack(all_token_embeddings, dim=0)  # [batch_size, n_ctx, d_model]
+        # pad all descriptions at once and run a single embedding gather instead
+        # of one small embedding + cat per description
+        lengths = [len(t) for t in auxiliary_texts]
+        pad_length = self.context_length - self.auxiliary_prefix_length
+        if max(lengths) > pad_length:
+            raise RuntimeError(f"Input text is too long for context length {self.context_length}")
+        # pad only to the batch max length: with the causal mask, positions past
+        # each [EOT] token never reach its representation, so the tail of the
+        # context window can be dropped outright
+        padded = nn.utils.rnn.pad_sequence(list(auxiliary_texts), batch_first=True)
+        # built on device so the eot gather in encode_text needs no host copy
+        eot_indices = torch.as_tensor([self.auxiliary_prefix_length + l - 1 for l in lengths], device=padded.device)
+        token_embeddings = self.token_embedding(padded).type(self.dtype)
+        if self.auxiliary_prefix_length > 0:
+            prefix = self.auxiliary_hoi_prefix.unsqueeze(0).expand(len(auxiliary_texts), -1, -1).type(self.dtype)
+            x = torch.cat([token_embeddings[:, :1], prefix, token_embeddings[:, 1:]], dim=1)
+        else:
+            x = token_embeddings  # [batch_size, n_ctx, d_model]
         return x, eot_indices
 
     def text_to_embedding(self, text, pure_words=False):
@@ -750,149 +985,242 @@ class HOIDetector(nn.Module):
                 [action text n, object text n],
             ]
         """
-        all_token_embeddings = []
-        eot_indices = []
+        num_texts = len(text)
+        tokens = [torch.cat([action_token, object_token]) for action_token, object_token in text]
+        lengths = [len(t) for t in tokens]
+
         if pure_words or (self.prefix_length == 0 and self.conjun_length == 0):
-            for action_token, object_token in text:
-                remain_length = self.context_length - len(action_token) - len(object_token)
-                if remain_length < 0:
-                    raise RuntimeError(f"Input text is too long for context length {self.context_length}")
-                eot_indices.append(self.context_length - remain_length - 1)
-                padding_zeros = torch.zeros(remain_length, dtype=torch.long).to(action_token.device)
-                token = torch.cat([action_token, object_token, padding_zeros])
-                token_embedding = self.token_embedding(token).type(self.dtype)
-                all_token_embeddings.append(token_embedding)
+            if max(lengths) > self.context_length:
+                raise RuntimeError(f"Input text is too long for context length {self.context_length}")
+            # pad only to the batch max length: under the causal mask the padded
+            # tail never influences the [EOT] features
+            padded = nn.utils.rnn.pad_sequence(tokens, batch_first=True)
+            eot_indices = torch.as_tensor([l - 1 for l in lengths], device=padded.device)
+            x = self.token_embedding(padded).type(self.dtype)  # [N_class, max_len, d_model]
+            return x, eot_indices
+
         elif self.prefix_length > 0 and self.conjun_length > 0:
+            pad_length = self.context_length - self.prefix_length - self.conjun_length
+            if max(lengths) > pad_length:
+                raise RuntimeError(f"Input text is too long for context length {self.context_length}")
+            # one padded embedding gather for all classes, padded only to the
+            # batch max length (the causally-masked tail is dead weight)
+            padded = nn.utils.rnn.pad_sequence(tokens, batch_first=True)
+            device = padded.device
+            eot_indices = torch.as_tensor([self.prefix_length + self.conjun_length + l - 1 for l in lengths], device=device)
+            token_embeddings = self.token_embedding(padded).type(self.dtype)  # N * S * D
+
             if self.text_scene_num > 0:
-                scene_prompt_prefix = self.text_scene_prompt_prefix_u.transpose(1, 2).contiguous() @ self.text_scene_prompt_prefix_v
-                scene_prompt_conjun = self.text_scene_prompt_conjun_u.transpose(1, 2).contiguous() @ self.text_scene_prompt_conjun_v
+                scene_prompt_prefix = _low_rank_prompt(self.text_scene_prompt_prefix_u, self.text_scene_prompt_prefix_v)
+                scene_prompt_conjun = _low_rank_prompt(self.text_scene_prompt_conjun_u, self.text_scene_prompt_conjun_v)
                 scene_prompt_prefix = self.hoi_prefix.unsqueeze(0) * scene_prompt_prefix # text_scene_num*L*512
                 scene_prompt_conjun = self.hoi_conjun.unsqueeze(0) * scene_prompt_conjun # text_scene_num*L'*512
                 # project to keys
-                scene_prompt_prefix_key = self.prompt_prefix_to_key(scene_prompt_prefix.transpose(1, 2).contiguous()).squeeze() # text_scene_num*512
-                scene_prompt_conjun_key = self.prompt_conjun_to_key(scene_prompt_conjun.transpose(1, 2).contiguous()).squeeze() # text_scene_num*512
-
-            for action_token, object_token in text:
-                remain_length = self.context_length - self.prefix_length - self.conjun_length - len(action_token) - len(object_token)
-                if remain_length < 0:
-                    raise RuntimeError(f"Input text is too long for context length {self.context_length}")
-                eot_indices.append(self.context_length - remain_length - 1)
-                padding_zeros = torch.zeros(remain_length, dtype=torch.long).to(action_token.device)
-                token = torch.cat([action_token, object_token, padding_zeros])
-                token_embedding = self.token_embedding(token).type(self.dtype)
-
-                if self.text_scene_num > 0:
-                    # import pdb; pdb.set_trace()
-                    # decode action and object token
-                    hoi_text = self._tokenizer.decode(action_token[1:].cpu().numpy().tolist()).strip() + " " + self._tokenizer.decode(object_token[:-1].cpu().numpy().tolist()).strip()
-                    if ' - ' in hoi_text:
-                        hoi_text = hoi_text.replace(' - ', '-')
-                    if hoi_text not in self.text_fingerprint_dict:
-                        pdb.set_trace()
-                    cur_text_fingerprint = torch.tensor(self.text_fingerprint_dict[hoi_text]).to(token.device).float()
-                    # use cur_text_fingerprint as query (1*512), scene_prompt_prefix_key as key (text_scene_num*512), scene_prompt_prefix as value (text_scene_num*L*512), calculate hoiprefix (L*512)
-                    attn_scores = F.softmax(cur_text_fingerprint @ scene_prompt_prefix_key.T, dim=-1)  # 1*text_scene_num
-                    top_scores, top_indices = attn_scores.topk(2, dim=-1)  # 1*top_n
-                    hoiprefix = (top_scores.unsqueeze(-1).unsqueeze(-1) * scene_prompt_prefix[top_indices]).sum(dim=1).squeeze(0)  # L*512
-                    # use cur_text_fingerprint as query (1*512), scene_prompt_conjun_key as key (text_scene_num*512), scene_prompt_conjun as value (text_scene_num*L'*512), calculate hoiconjun (L'*512)
-                    attn_scores = F.softmax(cur_text_fingerprint @ scene_prompt_conjun_key.T, dim=-1)  # 1*text_scene_num
-                    top_scores, top_indices = attn_scores.topk(2, dim=-1)  # 1*top_n
-                    hoiconjun = (top_scores.unsqueeze(-1).unsqueeze(-1) * scene_prompt_conjun[top_indices]).sum(dim=1).squeeze(0)  # L'*512
-
-                    full_token_embedding = torch.cat([
-                        token_embedding[0:1, :], hoiprefix, token_embedding[1:len(action_token), :],
-                        hoiconjun, token_embedding[len(action_token):, :]], dim=0)
-                else:
-                    full_token_embedding = torch.cat([
-                        token_embedding[0:1, :], self.hoi_prefix, token_embedding[1:len(action_token), :],
-                        self.hoi_conjun, token_embedding[len(action_token):, :]], dim=0)
-                all_token_embeddings.append(full_token_embedding)
-        
-        eot_indices = torch.as_tensor(eot_indices)
-        x = torch.stack(all_token_embeddings, dim=0)  # [N_class, 77, d_model]
-        return x, eot_indices
+                scene_prompt_prefix_key = self.prompt_prefix_to_key(scene_prompt_prefix.transpose(1, 2)).squeeze(-1) # text_scene_num*512
+                scene_prompt_conjun_key = self.prompt_conjun_to_key(scene_prompt_conjun.transpose(1, 2)).squeeze(-1) # text_scene_num*512
+
+                # one softmax + topk + weighted gather over all classes; queries are
+                # the per-class fingerprints (N*512), keys the scene prompt keys
+                fingerprints = self._get_text_fingerprints(text, device)  # N * 512
+                attn_scores = F.softmax(fingerprints @ scene_prompt_prefix_key.T, dim=-1)  # N * text_scene_num
+                top_scores, top_indices = attn_scores.topk(2, dim=-1)  # N * top_n
+                hoiprefix = torch.einsum('nt,ntld->nld', top_scores, scene_prompt_prefix[top_indices])  # N*L*512
+                attn_scores = F.softmax(fingerprints @ scene_prompt_conjun_key.T, dim=-1)
+                top_scores, top_indices = attn_scores.topk(2, dim=-1)
+                hoiconjun = torch.einsum('nt,ntld->nld', top_scores, scene_prompt_conjun[top_indices])  # N*L'*512
+            else:
+                hoiprefix = self.hoi_prefix.unsqueeze(0).expand(num_texts, -1, -1)
+                hoiconjun = self.hoi_conjun.unsqueeze(0).expand(num_texts, -1, -1)
+
+            # splice [SOT] + prefix + action + conjunction + object + padding with
+            # batched scatters: each token moves right by the prefix length (past
+            # the start token) plus the conjunction length (past the action)
+            n_action = torch.as_tensor([len(action_token) for action_token, _ in text], device=device)[:, None]
+            src = torch.arange(padded.shape[1], device=device)[None, :]
+            dest = src + self.prefix_length * (src >= 1).long() + self.conjun_length * (src >= n_action).long()
+            total_length = self.prefix_length + self.conjun_length + padded.shape[1]
+            x = token_embeddings.new_zeros(num_texts, total_length, token_embeddings.shape[-1])
+            x.scatter_(1, dest.unsqueeze(-1).expand_as(token_embeddings), token_embeddings)
+            x[:, 1:1 + self.prefix_length] = hoiprefix.type_as(x)
+            conjun_dest = n_action + self.prefix_length + torch.arange(self.conjun_length, device=device)[None, :]
+            x.scatter_(1, conjun_dest.unsqueeze(-1).expand(num_texts, self.conjun_length, x.shape[-1]), hoiconjun.type_as(x))
+            return x, eot_indices
+
+    def _get_text_fingerprints(self, text, device):
+        """ Gather the per-class text fingerprints as one [N, 512] tensor. The
+        tokenizer decode and dict lookup only run the first time a class is
+        seen; afterwards the class resolves to a row of the on-device
+        fingerprint table, so the batch is a single gather.
+        """
+        if not hasattr(self, "_text_fp_cache"):
+            self._text_fp_cache = {}
+        flat = torch.cat([t for pair in text for t in pair]).cpu().tolist()
+        rows = []
+        pos = 0
+        for action_token, object_token in text:
+            a_len, o_len = len(action_token), len(object_token)
+            key = tuple(flat[pos:pos + a_len + o_len])
+            pos += a_len + o_len
+            row = self._text_fp_cache.get(key)
+            if row is None:
+                # decode action (minus [SOT]) and object (minus [EOT]) tokens
+                hoi_text = self._tokenizer.decode(list(key[1:a_len])).strip() + " " + self._tokenizer.decode(list(key[a_len:a_len + o_len - 1])).strip()
+                if ' - ' in hoi_text:
+                    hoi_text = hoi_text.replace(' - ', '-')
+                if hoi_text not in self._text_fp_index:
+                    pdb.set_trace()
+                row = self._text_fp_index[hoi_text]
+                self._text_fp_cache[key] = row
+            rows.append(row)
+        return self.text_fp_table.to(device)[torch.as_tensor(rows, device=device)]
+
+    def _decode_vision(self, feature_map, decoder_mask, prompt_hint):
+        """ Run the HOI visual decoder, recomputing its activations in backward
+        when gradient checkpointing is enabled. """
+        if self.gradient_checkpointing and self.training:
+            return checkpoint(self.hoi_visual_decoder, feature_map, decoder_mask, prompt_hint, use_reentrant=False)
+        return self.hoi_visual_decoder(image=feature_map, mask=decoder_mask, prompt_hint=prompt_hint)
 
     def forward(self, image, text, image_mask, img_sizes, auxiliary_texts, cur_img_fingerprints):
         if self.use_prompt_hint:
-            prompt_hint = self.encode_text(text, pure_words=True)
-            prompt_hint = self.promp_proj(prompt_hint)
+            cache = None if self.training else self._prompt_hint_cache
+            if cache is not None and cache[0] is text:
+                prompt_hint = cache[1]
+            else:
+                prompt_hint = self.encode_text(text, pure_words=True)
+                prompt_hint = self.promp_proj(prompt_hint)
+                self._prompt_hint_cache = None if self.training else (text, prompt_hint)
         else:
             prompt_hint = torch.zeros(0, self.vision_width).to(image.device)
         
         bs, c, h, w = image.shape
         if self.clip_preprocess:
-            resized_img = [torchvision.transforms.Resize([self.input_resolution,self.input_resolution])(image[i][:, :img_sizes[i,0], :img_sizes[i,1]]) for i in range(bs)]
-            resized_img = torch.stack(resized_img, dim=0)
+            size = [self.input_resolution, self.input_resolution]
+            if bool((img_sizes == img_sizes[0]).all()):
+                # uniform sizes: one batched resize replaces bs separate kernels
+                resized_img = torchvision.transforms.functional.resize(
+                    image[:, :, :img_sizes[0, 0], :img_sizes[0, 1]], size)
+            else:
+                resized_img = torch.stack([
+                    torchvision.transforms.functional.resize(image[i][:, :img_sizes[i, 0], :img_sizes[i, 1]], size)
+                    for i in range(bs)], dim=0)
             decoder_mask = None
         else:
-            resized_img = torchvision.transforms.Resize([self.input_resolution,self.input_resolution])(image)
+            resized_img = torchvision.transforms.functional.resize(image, [self.input_resolution, self.input_resolution])
             raise NotImplementedError("undefined decoder_mask")
         
+        # the scene prompts and their keys only depend on the (frozen, in eval)
+        # prompt factors, so materialize the low-rank products once per eval run
         img_scene_prompts = None
-        if self.VPT_low_rank:
-            VPT = self.VPT_u.transpose(0, 1).contiguous() @ self.VPT_v
+        img_scene_prompt_key = None
+        cache = None if self.training else self._scene_prompt_cache
+        if cache is not None:
+            img_scene_prompts, img_scene_prompt_key = cache
         else:
-            VPT = self.VPT
-            
+            if self.VPT_low_rank:
+                VPT = _low_rank_prompt(self.VPT_u, self.VPT_v)
+            else:
+                VPT = self.VPT
+
+            if self.VPT_length > 0 and self.img_scene_num == 0:
+                img_scene_prompts = VPT
+            if self.img_scene_num > 0:
+                if self.low_rank:
+                    img_scene_prompts = _low_rank_prompt(self.img_scene_prompt_u, self.img_scene_prompt_v)
+                else:
+                    img_scene_prompts = self.img_scene_prompt
+                img_scene_prompts = img_scene_prompts * VPT.unsqueeze(0)
+                img_scene_prompt_key = self.img_scene_prompt_to_key(self.img_scene_prompt_to_key2(img_scene_prompts).transpose(1, 2)).squeeze(-1)
+            self._scene_prompt_cache = None if self.training else (img_scene_prompts, img_scene_prompt_key)
+
         if self.VPT_length > 0 and self.img_scene_num == 0:
-            img_scene_prompts = VPT.unsqueeze(0) + torch.zeros(bs, self.VPT_length, self.vision_width).type_as(image) # B*L*768
+            img_scene_prompts = img_scene_prompts.type_as(image).unsqueeze(0).expand(bs, -1, -1) # B*L*768
         if self.img_scene_num > 0:
-            if self.low_rank:
-                img_scene_prompts = self.img_scene_prompt_u.transpose(1, 2).contiguous() @ self.img_scene_prompt_v
-            else:
-                img_scene_prompts = self.img_scene_prompt
-            img_scene_prompts = img_scene_prompts * VPT.unsqueeze(0)
-            img_scene_prompt_key = self.img_scene_prompt_to_key(self.img_scene_prompt_to_key2(img_scene_prompts).transpose(1, 2).contiguous()).squeeze()
             # use cur_img_fingerprints as query (B*512), img_scene_prompt_key as key (img_scene_num*512), img_scene_prompts as value (img_scene_num*L*768), calculate updated img_scene_prompts (L*768)
             attn_scores = F.softmax(cur_img_fingerprints.float() @ img_scene_prompt_key.T, dim=-1)  # B*img_scene_num
             top_scores, top_indices = attn_scores.topk(self.pattern_num, dim=-1)  # B*top_n
-            img_scene_prompts = (top_scores.unsqueeze(-1).unsqueeze(-1) * img_scene_prompts[top_indices]).sum(dim=1)  # B*L*768
+            img_scene_prompts = torch.einsum('bt,btld->bld', top_scores, img_scene_prompts[top_indices])  # B*L*768
         
         # vision encoder
         feature_maps = self.encode_image(resized_img, self.multi_scale, self.f_idxs, img_scene_prompts)
         # vision decoder
         if self.multi_scale:
-            vision_output_lst = []
-            for idx in range(len(feature_maps)):
-                cur_feature_map = feature_maps[idx]
-                vision_output = self.hoi_visual_decoder(image=cur_feature_map, mask=decoder_mask, prompt_hint=prompt_hint)
+            num_levels = len(feature_maps)
+            if num_levels > 1 and len({fm.shape[1:] for fm in feature_maps}) == 1:
+                # all levels share the token count: fold them into the batch dim
+                # and run the decoder once instead of once per level
+                decoded = self._decode_vision(torch.cat(feature_maps, dim=0), decoder_mask, prompt_hint)
+                vision_outputs = {}
+                for key, value in decoded.items():
+                    if isinstance(value, list):
+                        # per-level region-prompt diagnostics: keep level 0's rows
+                        vision_outputs[key] = [v[:bs] for v in value]
+                        continue
+                    if not torch.is_tensor(value):  # attn_maps is None on the SDPA path
+                        vision_outputs[key] = value
+                        continue
+                    value = value.reshape(num_levels, bs, *value.shape[1:]).transpose(0, 1)
+                    vision_outputs[key] = value.reshape(bs, num_levels * value.shape[2], *value.shape[3:])
+                box_scores = vision_outputs["box_scores"]
+                num_queries = box_scores.shape[1] // num_levels
+                levels = torch.arange(num_levels, device=box_scores.device, dtype=box_scores.dtype)
                 if self.reverse_level_id:
-                    vision_output["level_id"] = torch.ones_like(vision_output['box_scores']) * (len(feature_maps)-idx) / max(1, len(feature_maps)-1)
-                else:
-                    vision_output["level_id"] = torch.ones_like(vision_output['box_scores']) * idx / max(1, len(feature_maps)-1)
-                vision_output_lst.append(vision_output)
-            vision_outputs = {}
-            key_lst = list(vision_output_lst[0].keys())
-            for k in key_lst:
-                vision_outputs[k] = torch.cat([vision_output_lst[scale_i][k] for scale_i in range(len(vision_output_lst))], dim=1)
+                    levels = num_levels - levels
+                levels = levels / max(1, num_levels - 1)
+                levels = levels.repeat_interleave(num_queries).view([1, box_scores.shape[1]] + [1] * (box_scores.dim() - 2))
+                vision_outputs["level_id"] = torch.ones_like(box_scores) * levels
+            else:
+                vision_output_lst = []
+                for idx in range(num_levels):
+                    cur_feature_map = feature_maps[idx]
+                    vision_output = self._decode_vision(cur_feature_map, decoder_mask, prompt_hint)
+                    if self.reverse_level_id:
+                        vision_output["level_id"] = torch.ones_like(vision_output['box_scores']) * (num_levels-idx) / max(1, num_levels-1)
+                    else:
+                        vision_output["level_id"] = torch.ones_like(vision_output['box_scores']) * idx / max(1, num_levels-1)
+                    vision_output_lst.append(vision_output)
+                vision_outputs = {}
+                key_lst = list(vision_output_lst[0].keys())
+                for k in key_lst:
+                    values = [vision_output_lst[scale_i][k] for scale_i in range(len(vision_output_lst))]
+                    if not torch.is_tensor(values[0]):
+                        # attn_maps may be None; region-prompt lists keep level 0's
+                        vision_outputs[k] = values[0]
+                        continue
+                    vision_outputs[k] = torch.cat(values, dim=1)
         else:
             feature_maps = self.vision_proj(feature_maps) # torch.Size([B, 196, 768])
-            vision_outputs = self.hoi_visual_decoder(image=feature_maps, mask=decoder_mask, prompt_hint=prompt_hint)
+            vision_outputs = self._decode_vision(feature_maps, decoder_mask, prompt_hint)
         
-        # text encoder
-        text_features = self.encode_text(text)
+        # text encoder: the class prompts are fixed during evaluation, so the
+        # text-transformer forward is memoized on the prompt list; training
+        # recomputes since the prompt parameters are learnable and the prompt
+        # set changes with each mini-batch
+        cache = None if self.training else self._encode_text_cache
+        if cache is not None and cache[0] is text:
+            text_features = cache[1]
+        else:
+            text_features = self.encode_text(text)
+            self._encode_text_cache = None if self.training else (text, text_features)
         if self.use_aux_text:
             # auxiliary_text_features = self.encode_text(auxiliary_texts, is_auxiliary_text=True)
             # auxiliary_text_features = auxiliary_text_features / auxiliary_text_features.norm(dim=-1, keepdim=True)
             auxiliary_text_features = torch.stack(auxiliary_texts, dim=0)
             auxiliary_text_features = self.hoi_calibrator(auxiliary_text_features)
-            auxiliary_text_features = auxiliary_text_features / auxiliary_text_features.norm(dim=-1, keepdim=True)
-        # normalized features
+            auxiliary_text_features = F.normalize(auxiliary_text_features, dim=-1)
+        # normalized features; the logit scale is folded into the (much
+        # smaller) text operand so the matmul output is not rescaled
+        # elementwise afterwards
         # image_features = vision_outputs["image_features"]
         # image_features = image_features / image_features.norm(dim=-1, keepdim=True)
         hoi_features = vision_outputs["hoi_features"]
-        hoi_features = hoi_features / hoi_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-
-        # [image level] cosine similarity as logits
-        logit_scale = self.logit_scale.exp()
-        # logits_per_image = logit_scale * image_features @ text_features.t()
-        # logits_per_text = logits_per_image.t()
+        hoi_features = F.normalize(hoi_features, dim=-1)
+        text_features = F.normalize(text_features, dim=-1) * self.logit_scale.exp()
 
         # [hoi level] cosine similarity between hoi_features and text_features
-        logits_per_hoi = logit_scale * hoi_features @ text_features.t() 
+        logits_per_hoi = hoi_features @ text_features.t()
         if self.use_aux_text:
-            logits_per_hoi = logits_per_hoi + self.auxiliary_logit_scale.exp() * hoi_features @ auxiliary_text_features.t()
+            logits_per_hoi = logits_per_hoi + hoi_features @ (self.auxiliary_logit_scale.exp() * auxiliary_text_features).t()
 
         return_dict = {
             # "logits_per_image": logits_per_image,
@@ -954,30 +1282,41 @@ class PostProcess(object):
         box_scores = outputs['box_scores'].sigmoid()
         scores = hoi_scores * (box_scores ** self.bbox_lambda)
 
-        # Filter out low confident ones
-        keep = torch.nonzero(scores > self.score_threshold, as_tuple=True)
-        scores = scores[keep]
-        classes = keep[1]
-        pred_person_boxes = pred_person_boxes[keep[0]]
-        pred_object_boxes = pred_object_boxes[keep[0]]
-
-        person_keep = batched_nms(pred_person_boxes, scores, classes, 0.5)
-        object_keep = batched_nms(pred_object_boxes, scores, classes, 0.5)
-
-        person_filter_mask = torch.zeros_like(scores, dtype=torch.bool)
-        object_filter_mask = torch.zeros_like(scores, dtype=torch.bool)
-        person_filter_mask[person_keep] = True
-        object_filter_mask[object_keep] = True
-        filter_mask = torch.logical_or(person_filter_mask, object_filter_mask)
-
-        scores = scores[filter_mask].detach().cpu().numpy().tolist()
-        classes = classes[filter_mask].detach().cpu().numpy().tolist()
-        pred_boxes = torch.cat([pred_person_boxes, pred_object_boxes], dim=-1)
-        pred_boxes = pred_boxes[filter_mask].detach().cpu().numpy().tolist()
-
-        results = []
-        for score, hoi_id, boxes in zip(scores, classes, pred_boxes):
-            results.append([hoi_mapper[int(hoi_id)], score] + boxes)
+        # Filter out low confident ones. Everything is derived from a single
+        # boolean mask via masked_select instead of going through
+        # torch.nonzero index tuples.
+        keep_mask = scores > self.score_threshold
+        num_queries, num_classes = scores.shape
+        query_ids = torch.arange(num_queries, device=scores.device).unsqueeze(-1).expand_as(scores)
+        class_ids = torch.arange(num_classes, device=scores.device).expand_as(scores)
+        scores = torch.masked_select(scores, keep_mask)
+        classes = torch.masked_select(class_ids, keep_mask)
+        query_ids = torch.masked_select(query_ids, keep_mask)
+        pred_person_boxes = pred_person_boxes[query_ids]
+        pred_object_boxes = pred_object_boxes[query_ids]
+
+        if scores.numel() == 0:
+            return []
+
+        # one NMS launch covers both box sets: the object boxes get offset
+        # class ids so person and object boxes never suppress each other
+        num_dets = scores.shape[0]
+        keep = batched_nms(
+            torch.cat([pred_person_boxes, pred_object_boxes], dim=0),
+            scores.repeat(2),
+            torch.cat([classes, classes + num_classes], dim=0), 0.5)
+        filter_mask = torch.zeros(2 * num_dets, dtype=torch.bool, device=scores.device)
+        filter_mask[keep] = True
+        filter_mask = torch.logical_or(filter_mask[:num_dets], filter_mask[num_dets:])
+
+        # Pack score, class and boxes into a single tensor so only one
+        # device-to-host copy is needed for the whole image.
+        detections = torch.cat([
+            scores.unsqueeze(-1), classes.unsqueeze(-1).float(),
+            pred_person_boxes, pred_object_boxes], dim=-1)
+        detections = detections[filter_mask].detach().cpu().tolist()
+
+        results = [[hoi_mapper[int(det[1])], det[0]] + det[2:] for det in detections]
 
         return results
 
@@ -990,28 +1329,19 @@ def _get_clones(module, N):
 def convert_weights(model: nn.Module):
     """Convert applicable model parameters to fp16"""
 
-    def _convert_weights_to_fp16(l):
-        if isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Linear)):
-            l.weight.data = l.weight.data.half()
-            if l.bias is not None:
-                l.bias.data = l.bias.data.half()
-
-        if isinstance(l, nn.MultiheadAttention):
-            for attr in [*[f"{s}_proj_weight" for s in ["in", "q", "k", "v"]], "in_proj_bias", "bias_k", "bias_v"]:
-                tensor = getattr(l, attr)
-                if tensor is not None:
-                    tensor.data = tensor.data.half()
-
-        nnParams_modules = [
-            "text_projection", "proj", "hoi_prefix", "hoi_conjun", "auxiliary_hoi_prefix", "hoi_pos_embed", "hoi_pos_embed2",
-            "hoi_token_embed", "class_embedding", "positional_embedding", "vision_mlp", "semantic_units"]
-        for name in nnParams_modules:
-            if hasattr(l, name):
-                attr = getattr(l, name)
-                if attr is not None:
-                    attr.data = attr.data.half()
+    def _to_fp16(tensor):
+        # only downcast fp32 tensors: the dtype-specific buffers (e.g. the
+        # bf16 parse masks) must keep their dtype
+        if tensor.is_floating_point() and tensor.dtype == torch.float32:
+            return tensor.half()
+        return tensor
 
-    model.apply(_convert_weights_to_fp16)
+    model._apply(_to_fp16)
+    # LayerNorm stays in fp32 (CLIP convention): its reductions are
+    # accuracy-sensitive in half precision
+    for m in model.modules():
+        if isinstance(m, nn.LayerNorm):
+            m.float()
 
 
 
@@ -1080,8 +1410,41 @@ def build_model(args):
         model.load_state_dict(state_dict, strict=False)
 
     if args.pretrained:
-        checkpoint = torch.load(args.pretrained, map_location='cpu')
-        model.load_state_dict(checkpoint["model"], strict=True)
+        ckpt = torch.load(args.pretrained, map_location='cpu')
+        model.load_state_dict(ckpt["model"], strict=True)
+
+    model.gradient_checkpointing = getattr(args, "gradient_checkpointing", False)
+
+    # the SDPA attention path does not expose attention probabilities, so the
+    # visualizer's cross-attention maps need the legacy MHA forward
+    if getattr(args, "vis_outputs", False):
+        for block in model.hoi_visual_decoder.transformer.resblocks:
+            block.need_attn_weights = True
+
+    # Optionally compile the HOI visual decoder (fixed image resolution and hoi token
+    # count, so static shapes). The repeated attention blocks are compiled
+    # individually first so the generated code is shared across layers and compile
+    # time stays low. Done after weight loading so checkpoint keys are unaffected;
+    # INPCC_COMPILE=0 (the default) keeps eager mode for debugging;
+    # INPCC_COMPILE=2 compiles the whole detector instead with dynamic shapes
+    # (batch and class counts vary across steps), fusing the remaining
+    # normalize/scale/softmax chains in forward. Graph breaks at the
+    # tokenizer/cache python code are tolerated.
+    compile_mode = os.environ.get("INPCC_COMPILE", "0")
+    if compile_mode == "1":
+        resblocks = model.hoi_visual_decoder.transformer.resblocks
+        for i, block in enumerate(resblocks):
+            resblocks[i] = torch.compile(block)
+        model.hoi_visual_decoder = torch.compile(model.hoi_visual_decoder, mode="max-autotune", dynamic=False)
+        # The text transformer is pure residual blocks with no data-dependent
+        # control flow, so it compiles in one graph per resblock; in eval the
+        # prompt set is fixed, so the graphs are reused across the whole run.
+        # Only done for inference: training keeps the plain module so
+        # checkpoint_sequential can walk transformer.resblocks directly.
+        if getattr(args, "eval", False):
+            model.transformer = torch.compile(model.transformer, dynamic=True)
+    elif compile_mode == "2":
+        model = torch.compile(model, mode="reduce-overhead", dynamic=True)
 
     # Build matcher and criterion
     matcher = build_matcher(args)
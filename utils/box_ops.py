@@ -89,6 +89,41 @@ def generalized_box_iou(boxes1, boxes2):
     return iou - (area - union) / area
 
 
+def generalized_box_iou_pairwise(boxes1, boxes2):
+    """
+    Pairwise (1-to-1) version of generalized_box_iou for equally-sized box sets.
+
+    The boxes should be in [x0, y0, x1, y1] format, with boxes1 and boxes2
+    both of shape [N, 4]
+
+    Returns a [N] tensor, avoiding the [N, M] matrix when only matched
+    pairs are needed
+    """
+    # degenerate boxes gives inf / nan results
+    # so do an early check
+    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
+    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    area1 = box_area(boxes1)
+    area2 = box_area(boxes2)
+
+    lt = torch.max(boxes1[:, :2], boxes2[:, :2])  # [N,2]
+    rb = torch.min(boxes1[:, 2:], boxes2[:, 2:])  # [N,2]
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    inter = wh[:, 0] * wh[:, 1]  # [N]
+
+    union = area1 + area2 - inter
+    iou = inter / union
+
+    lt = torch.min(boxes1[:, :2], boxes2[:, :2])
+    rb = torch.max(boxes1[:, 2:], boxes2[:, 2:])
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    area = wh[:, 0] * wh[:, 1]
+
+    return iou - (area - union) / area
+
+
 def masks_to_boxes(masks):
     """Compute the bounding boxes around the provided masks
 
@@ -12,6 +12,7 @@ import datetime
 import pickle
 from typing import Optional, List
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch import Tensor
@@ -265,6 +266,17 @@ def get_sha():
 def collate_fn(batch):
     batch = list(zip(*batch))
     batch[0] = nested_tensor_from_tensor_list(batch[0])
+    # Materialize the per-hoi annotation ids as contiguous tensors here, inside the
+    # dataloader workers, so the criterion can gather boxes/masks/labels with pure
+    # tensor indexing instead of walking the hoi dicts on the training thread.
+    for target in batch[1]:
+        if "hois" in target and "subject_ids" not in target:
+            target["subject_ids"] = torch.from_numpy(
+                np.asarray([hoi["subject_id"] for hoi in target["hois"]], dtype=np.int64))
+            target["object_ids"] = torch.from_numpy(
+                np.asarray([hoi["object_id"] for hoi in target["hois"]], dtype=np.int64))
+            target["hoi_ids"] = torch.from_numpy(
+                np.asarray([hoi["hoi_id"] for hoi in target["hois"]], dtype=np.int64))
     return tuple(batch)
 
 